@@ -2,37 +2,80 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import json
 import logging
 import os
+import time
 
+from celery import chain
+from celery import states
+from celery.utils import uuid
 from flask import Blueprint
+from flask import Response
 from flask import current_app
 from flask import jsonify
 from flask import request
 from werkzeug.exceptions import BadRequest
+from werkzeug.exceptions import InternalServerError
+from werkzeug.exceptions import NotFound
 from repository import MercurialException
 from repository import Repository
 from repository import UnknownRevisionException
 from relengapi import apimethod
 from relengapi import p
+from relengapi.lib import subcommands
 
 import tasks
 import actions
+import benchmark
 import rest
 
 logger = logging.getLogger(__name__)
 bp = Blueprint('transplant', __name__)
 
+DEFAULT_WAIT_TIMEOUT = 30
+MAX_WAIT_TIMEOUT = 60
+MIN_WAIT_INTERVAL = 0.5
+MAX_WAIT_INTERVAL = 2
+
 p.transplant.transplant.doc('Perform a transplant')
+p.transplant.metrics.doc('View transplant metrics')
+
 
 @bp.route('/repositories/<repository_id>/revsets/<revset>', methods=['GET'])
-@apimethod(rest.RevsetInfo, unicode, unicode)
+@apimethod(rest.RevsetInfo, unicode, unicode, unicode)
 @p.transplant.transplant.require()
-def revset_info(repository_id, revset):
-    """Get commit info by revset."""
+def revset_info(repository_id, revset, task=None):
+    """Get commit info by revset.
+
+    Info about revsets made of full changeset hashes (``rev1 + rev2 + rev3``)
+    never changes, so such responses can be cached and carry an ``ETag``.
+
+    With asynchronous lookups enabled, a revset that isn't cached is looked up
+    by a worker, and the response is ``202 Accepted`` with the ``task`` to pass
+    when asking again.
+    """
+
+    headers = {}
+    etag = None
+    nodes = actions.get_immutable_revset_nodes(revset)
+    if nodes is not None:
+        etag = actions.get_revset_etag(repository_id, nodes)
+        headers = {
+            'ETag': '"{}"'.format(etag),
+            'Cache-Control': actions.get_revset_cache_control(),
+            # JSON and HTML renderings differ
+            'Vary': 'Accept'
+        }
+
+        if request.if_none_match.contains(etag):
+            return Response(status=304, headers=headers)
+
+    if actions.is_async_lookups():
+        return lookup_revset_info(repository_id, revset, nodes, etag, task, headers)
 
     try:
-        return actions.get_revset_info(repository_id, revset)
+        return actions.get_revset_info(repository_id, revset), headers
     except actions.TooManyCommitsError, e:
         raise BadRequest(e.message)
     except actions.TransplantError, e:
@@ -41,14 +84,57 @@ def revset_info(repository_id, revset):
         raise BadRequest(e.message)
 
 
-@bp.route('/transplant', methods=['POST'])
-@apimethod(rest.TransplantTaskAsyncResult, body=rest.TransplantTask)
-@p.transplant.transplant.require()
-def transplant(transplant_task):
-    """Request a transplant job."""
+def lookup_revset_info(repository_id, revset, nodes, etag, task_id, headers):
+    if not actions.has_repo(repository_id):
+        raise BadRequest('Unknown repository: {}'.format(repository_id))
 
-    src = transplant_task.src
-    dst = transplant_task.dst
+    if nodes is not None:
+        revset_info = actions.get_cached_revset_info(repository_id, nodes)
+        if revset_info is not None:
+            return revset_info, headers
+
+    lookup_id = None
+    meta = None
+    if task_id is not None:
+        lookup_id = task_id
+        meta = tasks.get_lookup_meta(lookup_id)
+    elif nodes is not None:
+        # concurrent requests for the same immutable revset share a lookup
+        lookup_id = tasks.get_lookup_id(etag)
+        meta = tasks.get_lookup_meta(lookup_id)
+        if not tasks.is_shared_lookup(meta):
+            meta = None
+
+    if meta is None:
+        lookup_id = tasks.lookup_revset(repository_id, revset, task_id=lookup_id)
+        meta = {'status': tasks.LOOKUP_QUEUED, 'result': None}
+
+    state = meta['status']
+    if state == 'FAILURE':
+        raise InternalServerError('Lookup failed: {}'.format(meta['result']))
+
+    if state != 'SUCCESS':
+        # pending answers must not be cached
+        return rest.RevsetInfo(task=lookup_id, state=state), 202, {
+            'Cache-Control': 'no-cache'
+        }
+
+    value = meta['result']
+    if not isinstance(value, dict) or not ('commits' in value or 'error' in value):
+        raise BadRequest('Not a lookup task: {}'.format(lookup_id))
+
+    if 'error' in value:
+        raise BadRequest(value['error'])
+
+    revset_info = rest.RevsetInfo(
+        commits=[rest.CommitInfo(**commit) for commit in value['commits']])
+    if nodes is not None:
+        actions.cache_revset_info(repository_id, nodes, revset_info)
+
+    return revset_info, headers
+
+
+def get_items(transplant_task):
     items = []
     for transplant_item in transplant_task.items:
         item = {}
@@ -61,42 +147,313 @@ def transplant(transplant_task):
 
         items.append(item)
 
+    return items
+
+
+def get_dsts(transplant_task):
+    if transplant_task.dst and transplant_task.dsts:
+        raise BadRequest('Either dst or dsts must be set, not both')
+
+    if transplant_task.dsts:
+        # the same destination twice would only conflict with itself
+        dsts = []
+        for dst in transplant_task.dsts:
+            if dst not in dsts:
+                dsts.append(dst)
+        return dsts
+
+    if transplant_task.dst:
+        return [transplant_task.dst]
+
+    raise BadRequest('Either dst or dsts must be set')
+
+
+def check_transplant(src, dst):
+    """Get the reason why a transplant can't be performed, or None."""
+
     if not actions.has_repo(src):
-        msg = 'Unknown src repository: {}'.format(src)
-        raise BadRequest(msg)
+        return 'Unknown src repository: {}'.format(src)
 
     if not actions.has_repo(dst):
-        msg = 'Unknown dst repository: {}'.format(dst)
-        raise BadRequest(msg)
+        return 'Unknown dst repository: {}'.format(dst)
 
     if not actions.is_allowed_transplant(src, dst):
-        msg = 'Transplant from {} to {} is not allowed'.format(src, dst)
-        raise BadRequest(msg)
+        return 'Transplant from {} to {} is not allowed'.format(src, dst)
+
+    return None
+
+
+def get_task_meta(task_id):
+    # a single read of the result backend, which also has the progress and the outcome
+    return current_app.celery.backend.get_task_meta(task_id)
+
+
+def get_task_result(task_id, meta=None):
+    if meta is None:
+        meta = get_task_meta(task_id)
+
+    state = meta['status']
+    value = meta['result']
+    task_result = rest.TransplantTaskResult(
+        task=task_id,
+        state=state
+    )
+
+    if state == 'PROGRESS' and isinstance(value, dict):
+        task_result.version = value['version']
+        task_result.events = [rest.ProgressEvent(**event) for event in value['events']]
+
+    if state in states.READY_STATES:
+        if state != states.SUCCESS:
+            task_result.error = str(value)
+            return task_result
+
+        if 'tips' in value:
+            task_result.tips = value['tips']
+            task_result.errors = value['errors']
+        else:
+            task_result.tip = value['tip']
+
+    return task_result
+
+
+@bp.route('/transplant', methods=['POST'])
+@apimethod(rest.TransplantTaskAsyncResult, body=rest.TransplantTask)
+@p.transplant.transplant.require()
+def transplant(transplant_task):
+    """Request a transplant job."""
+
+    src = transplant_task.src
+    dsts = get_dsts(transplant_task)
+    items = get_items(transplant_task)
+
+    for dst in dsts:
+        msg = check_transplant(src, dst)
+        if msg is not None:
+            raise BadRequest(msg)
 
+    if len(dsts) > 1:
+        async_result = tasks.transplant_fan_out(src, dsts, items)
+    else:
+        async_result = tasks.transplant.apply_async((src, dsts[0], items), queue='transplant')
 
-    async_result = tasks.transplant.apply_async((src, dst, items), queue='transplant')
     return rest.TransplantTaskAsyncResult(task=async_result.id), 202
 
+
+@bp.route('/batch', methods=['POST'])
+@apimethod(rest.TransplantBatchAsyncResult, body=rest.TransplantBatch)
+@p.transplant.transplant.require()
+def transplant_batch(transplant_batch):
+    """Request several transplant jobs at once.
+
+    Jobs to the same destination repository are performed one after another,
+    in the order they're listed, and a failed job cancels the ones after it.
+    """
+
+    if not transplant_batch.tasks:
+        raise BadRequest('No tasks to perform')
+
+    errors = []
+    for i, transplant_task in enumerate(transplant_batch.tasks):
+        if transplant_task.dsts or not transplant_task.dst:
+            errors.append('Task {}: exactly one dst must be set in a batch'.format(i))
+            continue
+
+        msg = check_transplant(transplant_task.src, transplant_task.dst)
+        if msg is not None:
+            errors.append('Task {}: {}'.format(i, msg))
+
+    if errors:
+        raise BadRequest('\n'.join(errors))
+
+    # one chain per destination, the chains themselves run in parallel
+    chains = {}
+    for i, transplant_task in enumerate(transplant_batch.tasks):
+        signature = tasks.transplant.si(
+            transplant_task.src, transplant_task.dst, get_items(transplant_task))
+        signature.set(task_id=uuid(), queue='transplant')
+        chains.setdefault(transplant_task.dst, []).append((i, signature))
+
+    results = [None] * len(transplant_batch.tasks)
+    for signatures in chains.itervalues():
+        async_result = chain(*[s for _, s in signatures]).apply_async()
+        for i, _ in reversed(signatures):
+            results[i] = async_result
+            async_result = async_result.parent
+
+    # the results keep their parents, so the chains can be told from a restored batch
+    group_result = current_app.celery.GroupResult(uuid(), results)
+    group_result.save()
+
+    return rest.TransplantBatchAsyncResult(
+        batch=group_result.id,
+        tasks=[r.id for r in results]
+    ), 202
+
+
 @bp.route('/result/<task_id>', methods=['GET'])
 @apimethod(rest.TransplantTaskResult, unicode)
 @p.transplant.transplant.require()
 def result(task_id):
     """Get transplant job result."""
 
-    task = current_app.celery.AsyncResult(task_id)
-    task_result = rest.TransplantTaskResult(
-        task=task.id,
-        state=task.state
-    )
+    return get_task_result(task_id)
+
+
+@bp.route('/result/<task_id>/wait', methods=['GET'])
+@apimethod(rest.TransplantTaskResult, unicode, int, int)
+@p.transplant.transplant.require()
+def wait_result(task_id, version=0, timeout=DEFAULT_WAIT_TIMEOUT):
+    """Wait until a transplant job makes progress past `version`, or finishes.
 
-    if task.ready():
-        value = None
-        try:
-            value = task.get()
-        except Exception, e:
-            task_result.error = str(e)
+    Returns after `timeout` seconds (at most 60) at the latest, whatever the state is.
+    Pass the returned version to the next call to wait for the next progress event.
+    """
+
+    deadline = time.time() + min(max(timeout, 0), MAX_WAIT_TIMEOUT)
+    interval = MIN_WAIT_INTERVAL
+    while True:
+        meta = get_task_meta(task_id)
+        task_result = get_task_result(task_id, meta)
+        if meta['status'] in states.READY_STATES or (task_result.version or 0) > version:
             return task_result
 
-        task_result.tip = value['tip']
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return task_result
 
-    return task_result
+        # the result backend can't notify about changes, so poll it, less often over time
+        time.sleep(min(interval, remaining))
+        interval = min(interval * 2, MAX_WAIT_INTERVAL)
+
+
+@bp.route('/result/<task_id>/trace', methods=['GET'])
+@apimethod(rest.TransplantTaskTrace, unicode)
+@p.transplant.transplant.require()
+def result_trace(task_id):
+    """Get the execution trace of a finished transplant job.
+
+    The trace lists every hg command run by the job, with its resource usage,
+    and every stage of the job.
+    """
+
+    trace = current_app.celery.AsyncResult(tasks.get_trace_id(task_id))
+    if trace.state != 'SUCCESS':
+        raise NotFound('No trace of task: {}'.format(task_id))
+
+    value = trace.result
+    return rest.TransplantTaskTrace(
+        task=task_id,
+        time=value['time'],
+        duration=value['duration'],
+        events=[rest.TraceEvent(**event) for event in value['events']]
+    )
+
+
+@bp.route('/batch/<batch_id>', methods=['GET'])
+@apimethod(rest.TransplantBatchResult, unicode)
+@p.transplant.transplant.require()
+def batch_result(batch_id):
+    """Get results of all jobs of a transplant batch."""
+
+    group_result = current_app.celery.GroupResult.restore(batch_id)
+    if group_result is None:
+        raise NotFound('Unknown batch: {}'.format(batch_id))
+
+    results = []
+    for task in group_result.results:
+        task_result = get_task_result(task.id)
+        if task_result.state == 'PENDING':
+            parent = task.parent
+            while parent is not None and parent.state != 'FAILURE':
+                parent = parent.parent
+
+            if parent is not None:
+                task_result.state = 'SKIPPED'
+                task_result.error = 'Previous task {} has failed'.format(parent.id)
+
+        results.append(task_result)
+
+    result_states = set(r.state for r in results)
+    if result_states == set(['SUCCESS']):
+        state = 'SUCCESS'
+    elif result_states <= set(['SUCCESS', 'FAILURE', 'SKIPPED']):
+        state = 'FAILURE'
+    else:
+        state = 'PENDING'
+
+    return rest.TransplantBatchResult(
+        batch=group_result.id,
+        state=state,
+        results=results
+    )
+
+
+@bp.route('/metrics', methods=['GET'])
+@p.transplant.metrics.require()
+def metrics():
+    """Get timings of hg commands and transplant stages in Prometheus text format."""
+
+    text = actions.export_metrics()
+    if text is None:
+        raise NotFound('Metrics are disabled')
+
+    return Response(text, content_type='text/plain; version=0.0.4')
+
+
+class WarmUpSubcommand(subcommands.Subcommand):
+
+    def make_parser(self, subparsers):
+        parser = subparsers.add_parser(
+            'transplant-warm-up', help='Clone or refresh all transplant repositories')
+        parser.add_argument("-j", "--concurrency", type=int, default=None,
+                            help='Number of repositories to process in parallel')
+        return parser
+
+    def run(self, parser, args):
+        def progress(name, done, total, error):
+            status = 'FAILED: {}'.format(error) if error else 'ok'
+            print '[{}/{}] {} {}'.format(done, total, name, status)
+
+        errors = actions.warm_up(concurrency=args.concurrency, progress=progress)
+        if errors:
+            parser.exit(1, 'failed to warm up: {}\n'.format(', '.join(sorted(errors))))
+
+
+class BenchmarkSubcommand(subcommands.Subcommand):
+
+    def make_parser(self, subparsers):
+        parser = subparsers.add_parser(
+            'transplant-benchmark',
+            help='Time transplant operations on generated local repositories')
+        parser.add_argument("--commits", type=int, default=1000,
+                            help='Number of commits in the generated history')
+        parser.add_argument("--files", type=int, default=100,
+                            help='Number of files in the generated repositories')
+        parser.add_argument("--file-size", type=int, default=4096,
+                            help='Approximate size of each file, in bytes')
+        parser.add_argument("--heads", type=int, default=1,
+                            help='Number of heads in the generated history')
+        parser.add_argument("--repeat", type=int, default=3,
+                            help='Number of runs of each benchmark')
+        parser.add_argument("--seed", type=int, default=0,
+                            help='Seed of the generated history')
+        parser.add_argument("-o", "--output", default='transplant-benchmark.json',
+                            help='File to write JSON results to')
+        return parser
+
+    def run(self, parser, args):
+        def progress(name, done, total, duration):
+            print '[{}/{}] {} {:.3f}s'.format(done, total, name, duration)
+
+        results = benchmark.run(commits=args.commits, files=args.files,
+                                file_size=args.file_size, heads=args.heads,
+                                repeat=args.repeat, seed=args.seed, progress=progress)
+
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, default=str)
+            f.write('\n')
+
+        for name, result in results['results'].iteritems():
+            print '{:<24} min {:.3f}s  median {:.3f}s  max {:.3f}s'.format(
+                name, result['min'], result['median'], result['max'])
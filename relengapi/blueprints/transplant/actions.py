@@ -2,32 +2,116 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import contextlib
+import hashlib
+import json
 import logging
+import multiprocessing.pool
 import os
 import re
+import shutil
+import sqlite3
+import tempfile
+import time
 
 from flask import current_app
+from flask import g
+from flask import has_app_context
 
 from repository import Repository
 from repository import MercurialException
 from repository import UnknownRevisionException
 
+from cache import LRUCache
+from checkpoint import Checkpoint
+from checkpoint import prune_checkpoints
+from commitindex import CommitIndex
+from metrics import Metrics
+from metrics import collect_metrics
+from metrics import render_metrics
+from patches import PatchCache
+from registry import RepositoryRegistry
+from singleflight import SingleFlight
+from spool import JobSpool
+
+import locks
 import rest
 
 DEFAULT_WORKDIR = '/var/lib/transplant'
 DEFAULT_REPOSITORIES = []
+DEFAULT_COMMAND_SERVER = False
+DEFAULT_COMMAND_SERVER_POOL_SIZE = 2
+DEFAULT_WORKING_COPIES = 0
+DEFAULT_REPOSITORY_REGISTRY = 'task'
+DEFAULT_COMMIT_INDEX = False
+DEFAULT_REVSET_CACHE_SIZE = 1000
+DEFAULT_REVSET_CACHE_CONTROL = 'public, max-age=31536000'
+DEFAULT_SYNC_INTERVAL = 300
+DEFAULT_SYNC_MAX_AGE = 0
+DEFAULT_WARM_UP = False
+DEFAULT_WARM_UP_CONCURRENCY = 4
+DEFAULT_SQUASH_MODE = 'collapse'
+DEFAULT_TRANSFER_MODE = 'transplant'
+DEFAULT_PATCH_CACHE_SIZE = 1000
+DEFAULT_PUSH_COALESCING = 0
+DEFAULT_METRICS = False
+DEFAULT_STREAM_CLONE = False
+DEFAULT_SEED_DIR = None
+DEFAULT_ASYNC_LOOKUPS = False
+DEFAULT_LOOKUP_TIME_LIMIT = 300
+DEFAULT_MAX_COMMITS = 100
+DEFAULT_CHUNK_SIZE = 50
+DEFAULT_CHECKPOINTS = False
+DEFAULT_BRANCH = 'default'
 
 PROJECT_DIR = os.path.dirname(os.path.realpath(__file__))
-TRANSPLANT_FILTER = os.path.join(PROJECT_DIR, 'transplant_filter.py')
-MAX_COMMITS = 100
+CHECKPOINT_MAX_AGE = 24 * 60 * 60
+
+# strings, function calls, parentheses and symbols of a revset
+REVSET_TOKEN_RE = re.compile(
+    r'''('(?:\\.|[^\\'])*'|"(?:\\.|[^\\"])*")|([\w.@]+)\s*\(|(\()|(\))|([\w.@]+)''')
+
+# a symbol that may be a (short) changeset hash
+NODE_SYMBOL_RE = re.compile(r'^[0-9a-fA-F]{6,40}$')
+
+# revset functions whose arguments are strings or patterns, never changesets
+STRING_FUNCTIONS = frozenset([
+    'adds', 'author', 'bookmark', 'contains', 'date', 'desc', 'extra', 'file',
+    'filelog', 'follow', 'grep', 'keyword', 'modifies', 'removes', 'tag', 'user'
+])
+
+UNKNOWN_REVISION_RE = re.compile(r"unknown revision '([^']*)'")
+
+# "rev1 + rev2 + rev3", where revs are long enough not to be mistaken for revision numbers
+NODES_REVSET_RE = re.compile(r'^\s*[0-9a-fA-F]{12,40}(\s*\+\s*[0-9a-fA-F]{12,40})*\s*$')
+
+# "rev1 + rev2 + rev3" of full changeset hashes, which always resolve to the same commits
+FULL_NODES_REVSET_RE = re.compile(r'^\s*[0-9a-fA-F]{40}(\s*\+\s*[0-9a-fA-F]{40})*\s*$')
+
+# purging only the touched files is not worth it for very large jobs
+MAX_PURGE_PATTERNS = 1000
+GLOB_SPECIAL_RE = re.compile(r'[\\\[\]*?{},]')
+
+# results of coalesced jobs are kept for a day, identical jobs (e.g. redelivered ones) share them
+SPOOL_RESULT_MAX_AGE = 24 * 60 * 60
 
 Repository.register_extension(
     'collapse',
     os.path.join(PROJECT_DIR, 'vendor', 'hgext', 'collapse.py')
 )
 
+Repository.register_extension(
+    'transplantmessage',
+    os.path.join(PROJECT_DIR, 'hgext', 'transplantmessage.py')
+)
+
 logger = logging.getLogger(__name__)
 
+_process_registry = RepositoryRegistry()
+_revset_info_cache = None
+_metrics = None
+_single_flight = SingleFlight()
+
 
 def is_allowed_transplant(src, dst):
     return src != dst
@@ -78,169 +162,1582 @@ def get_repo_dir(name):
     return os.path.abspath(os.path.join(workdir, name))
 
 
+def get_repo_branch(name):
+    """Get the branch that jobs for repository `name` are transplanted onto."""
+
+    repository = find_repo(name)
+    if repository is None:
+        raise TransplantError('unknown repository: {}'.format(name))
+
+    return repository.get('branch', DEFAULT_BRANCH)
+
+
+def get_upstream_head(name):
+    # the latest upstream changeset, as changesets created locally are drafts
+    return "max(public() and branch('{}'))".format(get_repo_branch(name))
+
+
+def get_phase_lock_dir(repo):
+    """Get the lock that guards the phases in the store of `repo`.
+
+    hg transplant makes the changesets it pulls public until they're made drafts again,
+    so it holds the lock shared, while working copies that share the store hold it
+    exclusively to find the upstream head.
+    """
+
+    store_dir = repo.path
+    shared_path = os.path.join(repo.path, '.hg', 'sharedpath')
+    if os.path.exists(shared_path):
+        with open(shared_path) as f:
+            store_dir = os.path.dirname(f.read().strip())
+
+    return store_dir + '.phases'
+
+
+def get_sync_interval(name):
+    """Get how often (in seconds) repository `name` is synced in background, or None.
+
+    Repositories bootstrapped from a base repository (like try) are too big
+    to pull unconditionally, so they're not synced unless explicitly configured.
+    """
+
+    repository = find_repo(name)
+    if repository is None:
+        raise TransplantError('unknown repository: {}'.format(name))
+
+    if 'sync_interval' in repository:
+        return repository['sync_interval'] or None
+
+    if 'base' in repository:
+        return None
+
+    return current_app.config.get('TRANSPLANT_SYNC_INTERVAL', DEFAULT_SYNC_INTERVAL) or None
+
+
+def get_sync_stamp_path(name):
+    return get_repo_dir(name) + '.synced'
+
+
+def get_last_sync(name):
+    try:
+        with open(get_sync_stamp_path(name)) as f:
+            return float(f.read())
+    except (IOError, ValueError):
+        return None
+
+
+def mark_synced(name):
+    with open(get_sync_stamp_path(name), 'w') as f:
+        f.write(repr(time.time()))
+
+
+def is_fresh(name):
+    max_age = current_app.config.get('TRANSPLANT_SYNC_MAX_AGE', DEFAULT_SYNC_MAX_AGE)
+    if not max_age:
+        return False
+
+    last_sync = get_last_sync(name)
+    return last_sync is not None and time.time() - last_sync < max_age
+
+
+def get_repo_config(name):
+    return {
+        "paths": {
+            "default": get_repo_url(name),
+            "base": get_repo_base_url(name)
+        }
+    }
+
+
+def get_registry():
+    """Get the registry of prepared repositories.
+
+    By default it lives in the application context, i.e. it's shared by
+    everything that runs within one Celery task or one HTTP request.
+    """
+
+    scope = current_app.config.get('TRANSPLANT_REPOSITORY_REGISTRY', DEFAULT_REPOSITORY_REGISTRY)
+    if scope == 'process':
+        return _process_registry
+
+    if not hasattr(g, 'transplant_repositories'):
+        g.transplant_repositories = RepositoryRegistry()
+
+    return g.transplant_repositories
+
+
+def get_working_copies_count():
+    return current_app.config.get('TRANSPLANT_WORKING_COPIES', DEFAULT_WORKING_COPIES)
+
+
+def get_working_copy_dirs(name):
+    working_copies_dir = get_repo_dir(name) + '.wc'
+    if not os.path.exists(working_copies_dir):
+        os.makedirs(working_copies_dir)
+
+    count = get_working_copies_count()
+    return [os.path.join(working_copies_dir, str(slot)) for slot in range(count)]
+
+
+def get_push_lock_dir(name):
+    return os.path.join(get_repo_dir(name) + '.wc', 'push')
+
+
+def get_commit_index(repository):
+    if not current_app.config.get('TRANSPLANT_COMMIT_INDEX', DEFAULT_COMMIT_INDEX):
+        return None
+
+    # working copies share the index of their store
+    return CommitIndex(repository.store_path() + '.commits.db')
+
+
+def update_commit_index(repository):
+    index = get_commit_index(repository)
+    if index is None:
+        return
+
+    try:
+        index.update(repository)
+    except sqlite3.Error, e:
+        # the index is only a cache, hg is still the source of truth
+        logger.warning('failed to update commit index of "%s": %s', repository.path, e)
+
+
+def split_nodes_revset(revset):
+    revs = []
+    for rev in re.split('\s*\+\s*', revset.strip().lower()):
+        if rev not in revs:
+            revs.append(rev)
+
+    return revs
+
+
+def lookup_commit_index(repository, revset):
+    index = get_commit_index(repository)
+    if index is None or not NODES_REVSET_RE.match(revset):
+        return None
+
+    revs = split_nodes_revset(revset)
+    try:
+        return index.lookup(revs)
+    except sqlite3.Error, e:
+        logger.warning('failed to look up commit index of "%s": %s', repository.path, e)
+        return None
+
+
+def configure_command_server():
+    if not current_app.config.get('TRANSPLANT_COMMAND_SERVER', DEFAULT_COMMAND_SERVER):
+        return
+
+    max_idle = current_app.config.get('TRANSPLANT_COMMAND_SERVER_POOL_SIZE',
+                                      DEFAULT_COMMAND_SERVER_POOL_SIZE)
+    Repository.enable_command_server(max_idle=max_idle)
+
+
+def get_metrics_dir():
+    workdir = current_app.config.get('TRANSPLANT_WORKDIR', DEFAULT_WORKDIR)
+    return os.path.join(workdir, '.metrics')
+
+
+def get_metrics():
+    """Get metrics of this process, or None if they're disabled."""
+
+    global _metrics
+    if not current_app.config.get('TRANSPLANT_METRICS', DEFAULT_METRICS):
+        return None
+
+    if _metrics is None:
+        _metrics = Metrics(get_metrics_dir())
+
+    return _metrics
+
+
+def configure_command_observer():
+    workdir = os.path.abspath(current_app.config.get('TRANSPLANT_WORKDIR', DEFAULT_WORKDIR))
+    Repository.set_command_observer(make_command_observer(get_metrics(), workdir))
+
+
+def make_command_observer(metrics, workdir):
+    def observe(command, path, outcome, duration, output_size, args=(), error_size=0,
+                rusage=None):
+        trace = get_trace()
+        if trace is not None:
+            trace.add_command(command, args, path, outcome, duration, output_size,
+                              error_size, rusage)
+
+        if metrics is None:
+            return
+
+        labels = {
+            'command': command or '',
+            'repository': os.path.relpath(path, workdir) if path else ''
+        }
+        metrics.inc('transplant_hg_command_output_bytes_total', labels, output_size)
+
+        labels['outcome'] = outcome
+        metrics.observe('transplant_hg_command_duration_seconds', labels, duration)
+
+    return observe
+
+
+def get_trace():
+    """Get the trace of the current job, or None if it's not traced."""
+
+    # hg commands may run outside of a job, e.g. in a warm up thread
+    if not has_app_context():
+        return None
+
+    return getattr(g, 'transplant_trace', None)
+
+
+@contextlib.contextmanager
+def tracing(trace):
+    """Record hg commands and stages of jobs run in the block in `trace`."""
+
+    previous = getattr(g, 'transplant_trace', None)
+    g.transplant_trace = trace
+    try:
+        yield
+    finally:
+        g.transplant_trace = previous
+
+
+@contextlib.contextmanager
+def stage(name):
+    """Time a stage of a transplant job, for metrics and the trace of the job."""
+
+    metrics = get_metrics()
+    trace = get_trace()
+    start = time.time()
+    outcome = 'error'
+    try:
+        yield
+        outcome = 'ok'
+    finally:
+        duration = time.time() - start
+        if metrics is not None:
+            labels = {'stage': name, 'outcome': outcome}
+            metrics.observe('transplant_stage_duration_seconds', labels, duration)
+
+        if trace is not None:
+            trace.add_stage(name, outcome, start, duration)
+
+
+def report_progress(event, **details):
+    """Tell whoever is interested in the current job that it has made progress."""
+
+    callback = getattr(g, 'transplant_progress', None)
+    if callback is not None:
+        callback(event, **details)
+
+
+@contextlib.contextmanager
+def reporting_progress(callback):
+    """Send progress events of jobs run in the block to `callback`, or nowhere if it's None."""
+
+    previous = getattr(g, 'transplant_progress', None)
+    g.transplant_progress = callback
+    try:
+        yield
+    finally:
+        g.transplant_progress = previous
+
+
+def flush_metrics():
+    if _metrics is not None:
+        _metrics.flush()
+
+
+def export_metrics():
+    """Get metrics of all processes in Prometheus text format, or None if they're disabled."""
+
+    metrics = get_metrics()
+    if metrics is None:
+        return None
+
+    metrics.flush()
+    return render_metrics(collect_metrics(get_metrics_dir()))
+
+
 def clone(name, force_update=False):
-    repo_url = get_repo_url(name)
+    configure_command_server()
+    configure_command_observer()
+
     repo_dir = get_repo_dir(name)
-    repo_base_url = get_repo_base_url(name)
+    repo_config = get_repo_config(name)
+    registry = get_registry()
+
+    repository = registry.get(repo_dir, repo_config)
+    if repository is not None and not force_update:
+        return repository
+
+    with locks.repository_lock(repo_dir):
+        if force_update or not is_cloned(repo_dir):
+            with locks.repository_lock(repo_dir, exclusive=True):
+                repository = clone_or_pull(name, repo_dir, force_update)
+        else:
+            logger.info('repository "%s" is already cloned', name)
+            repository = Repository(repo_dir)
+
+        repository.set_config(repo_config)
+
+    registry.add(repository, repo_config)
+    return repository
+
+
+def is_cloned(repo_dir):
+    return os.path.exists(os.path.join(repo_dir, '.hg'))
+
+
+def get_seed(name):
+    """Get the local repository or bundle to bootstrap the clone of `name` from, or None."""
+
+    seed = find_repo(name).get('seed')
+    if seed is not None:
+        if not os.path.exists(seed):
+            logger.warning('seed "%s" of repository "%s" doesn\'t exist', seed, name)
+            return None
+
+        return seed
+
+    seed_dir = current_app.config.get('TRANSPLANT_SEED_DIR', DEFAULT_SEED_DIR)
+    if seed_dir is None:
+        return None
+
+    for seed in (os.path.join(seed_dir, name), os.path.join(seed_dir, name + '.hg')):
+        if os.path.exists(seed):
+            return seed
+
+    return None
+
+
+def clone_from_seed(name, seed, repo_dir):
+    """Create the clone of `name` from a local seed, then pull whatever the seed is missing."""
+
+    # a half-seeded repository must never look cloned
+    tmp_dir = repo_dir + '.seeding'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    try:
+        if os.path.isdir(seed):
+            # local clones hardlink the store instead of copying it
+            repository = Repository.clone(seed, tmp_dir, noupdate=True)
+        else:
+            repository = Repository.init(tmp_dir)
+            repository.unbundle(seed)
+
+        repository.pull(source=get_repo_base_url(name))
+        repository.update()
+        if os.path.isdir(repo_dir):
+            os.rmdir(repo_dir)
+
+        os.rename(tmp_dir, repo_dir)
+    except Exception:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+    return Repository(repo_dir)
+
+
+def clone_or_pull(name, repo_dir, force_update=False):
+    # the repository may have been cloned while we were waiting for the lock
+    if not is_cloned(repo_dir):
+        repository = None
+        seed = get_seed(name)
+        if seed is not None:
+            logger.info('cloning repository "%s" from seed "%s"', name, seed)
+            try:
+                repository = clone_from_seed(name, seed, repo_dir)
+            except (MercurialException, OSError), e:
+                logger.warning('failed to clone repository "%s" from seed "%s", '
+                               'cloning from scratch: %s', name, seed, e)
+
+        if repository is None:
+            logger.info('cloning repository "%s"', name)
+            stream = current_app.config.get('TRANSPLANT_STREAM_CLONE', DEFAULT_STREAM_CLONE)
+            repository = Repository.clone(get_repo_base_url(name), repo_dir, uncompressed=stream)
+
+        # the working copy stays on its branch when updated later
+        if get_repo_branch(name) != DEFAULT_BRANCH:
+            repository.update(rev=get_repo_branch(name))
+
+        update_commit_index(repository)
+        if get_repo_base_url(name) == get_repo_url(name):
+            mark_synced(name)
+
+        return repository
+
+    logger.info('repository "%s" is already cloned', name)
+    repository = Repository(repo_dir)
+    if force_update and is_fresh(name):
+        logger.info('repository "%s" was synced recently, updating only', name)
+        repository.update()
+    elif force_update:
+        logger.info('pulling / updating repository "%s"', name)
+        repository.pull(update=True)
+        update_commit_index(repository)
+        mark_synced(name)
+
+    return repository
+
+
+def sync_repositories():
+    """Pull every configured repository whose sync interval has passed."""
+
+    repositories = current_app.config.get('TRANSPLANT_REPOSITORIES', DEFAULT_REPOSITORIES)
+    for repository in repositories:
+        name = repository['name']
+        interval = get_sync_interval(name)
+        if interval is None:
+            continue
+
+        last_sync = get_last_sync(name)
+        if last_sync is not None and time.time() - last_sync < interval:
+            continue
+
+        try:
+            sync(name)
+        except MercurialException, e:
+            # don't let one unreachable repository block the others
+            logger.error('failed to sync repository "%s": %s', name, e)
+
+
+def sync(name):
+    logger.info('syncing repository "%s"', name)
+    repository = clone(name)
+
+    # pulling doesn't touch the working directory, so a shared lock is enough
+    with locks.repository_lock(repository.path):
+        repository.pull()
+        update_commit_index(repository)
 
-    if not os.path.exists(os.path.join(repo_dir, '.hg')):
-        logger.info('cloning repository "%s"', name)
-        repository = Repository.clone(repo_base_url, repo_dir)
+    mark_synced(name)
+
+
+def warm_up(concurrency=None, progress=None):
+    """Clone or refresh all configured repositories in parallel.
+
+    `progress` is called as progress(name, done, total, error) after each repository.
+    Returns a dictionary of repository names that failed to their errors.
+    """
+
+    if concurrency is None:
+        concurrency = current_app.config.get('TRANSPLANT_WARM_UP_CONCURRENCY',
+                                             DEFAULT_WARM_UP_CONCURRENCY)
+
+    repositories = current_app.config.get('TRANSPLANT_REPOSITORIES', DEFAULT_REPOSITORIES)
+    names = [repository['name'] for repository in repositories]
+    if not names:
+        return {}
+
+    # every thread needs its own application context
+    app = current_app._get_current_object()
+
+    def warm_up_one(name):
+        with app.app_context():
+            try:
+                warm_up_repository(name)
+                return name, None
+            except Exception, e:
+                logger.exception('failed to warm up repository "%s"', name)
+                return name, e
+
+    errors = {}
+    pool = multiprocessing.pool.ThreadPool(min(concurrency, len(names)))
+    try:
+        results = pool.imap_unordered(warm_up_one, names)
+        for done, (name, error) in enumerate(results, 1):
+            if error is not None:
+                errors[name] = error
+
+            logger.info('warmed up %d of %d repositories ("%s" %s)',
+                        done, len(names), name, 'failed' if error else 'done')
+            if progress is not None:
+                progress(name, done, len(names), error)
+    finally:
+        pool.close()
+        pool.join()
+
+    return errors
+
+
+def warm_up_repository(name):
+    clone(name)
+
+    interval = get_sync_interval(name)
+    if interval is None:
+        return
+
+    last_sync = get_last_sync(name)
+    if last_sync is None or time.time() - last_sync >= interval:
+        sync(name)
+
+
+def share(name, repo_dir):
+    """Get a working copy of repository `name` that shares its store."""
+
+    repo_config = get_repo_config(name)
+    registry = get_registry()
+
+    repository = registry.get(repo_dir, repo_config)
+    if repository is not None:
+        return repository
+
+    if not is_cloned(repo_dir):
+        logger.info('sharing repository "%s" into "%s"', name, repo_dir)
+        repository = Repository.share(get_repo_dir(name), repo_dir, noupdate=True)
     else:
-        logger.info('repository "%s" is already cloned', name)
         repository = Repository(repo_dir)
-        if force_update:
-            logger.info('pulling / updating repository "%s"', name)
-            repository.pull(update=True)
 
-    repository.set_config({
-        "paths": {
-            "default": repo_url,
-            "base": repo_base_url
-        }
-    })
+    # paths are not shared, every working copy has its own hgrc
+    repository.set_config(repo_config)
 
+    registry.add(repository, repo_config)
     return repository
 
 
+def get_revset_info_cache():
+    global _revset_info_cache
+    if _revset_info_cache is None:
+        max_size = current_app.config.get('TRANSPLANT_REVSET_CACHE_SIZE', DEFAULT_REVSET_CACHE_SIZE)
+        _revset_info_cache = LRUCache(max_size)
+
+    return _revset_info_cache
+
+
+def get_immutable_revset_nodes(revset):
+    """Get the nodes of a revset made of full changeset hashes only, otherwise None.
+
+    Info about such revsets never changes, so it can be cached.
+    """
+
+    if not FULL_NODES_REVSET_RE.match(revset):
+        return None
+
+    return tuple(split_nodes_revset(revset))
+
+
+def get_revset_etag(repository_id, nodes):
+    key = u'\0'.join((repository_id,) + nodes)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def get_revset_cache_control():
+    return current_app.config.get('TRANSPLANT_REVSET_CACHE_CONTROL', DEFAULT_REVSET_CACHE_CONTROL)
+
+
+def get_cached_revset_info(repository_id, nodes):
+    return get_revset_info_cache().get((repository_id, nodes))
+
+
+def cache_revset_info(repository_id, nodes, revset_info):
+    get_revset_info_cache().put((repository_id, nodes), revset_info)
+
+
+def is_async_lookups():
+    return current_app.config.get('TRANSPLANT_ASYNC_LOOKUPS', DEFAULT_ASYNC_LOOKUPS)
+
+
+def get_lookup_time_limit():
+    return current_app.config.get('TRANSPLANT_LOOKUP_TIME_LIMIT', DEFAULT_LOOKUP_TIME_LIMIT)
+
+
 def get_revset_info(repository_id, revset):
-    repository = clone(repository_id)
-    commits = optimistic_log(repository, revset)
-    commits_count = len(commits)
-    if commits_count > MAX_COMMITS:
-        msg = too_many_commits_error(commits_count, MAX_COMMITS)
+    nodes = get_immutable_revset_nodes(revset)
+    if nodes is not None:
+        revset_info = get_cached_revset_info(repository_id, nodes)
+        if revset_info is not None:
+            return revset_info
+
+    def lookup():
+        repository = clone(repository_id)
+        commits = lookup_commit_index(repository, revset)
+        if commits is None:
+            commits = limited_log(repository, revset)
+
+        return rest.RevsetInfo(commits=commits)
+
+    # identical lookups right after a push would all run hg log, and likely pull
+    revset_info = _single_flight.do(('revset_info', repository_id, revset), lookup)
+    if nodes is not None:
+        cache_revset_info(repository_id, nodes, revset_info)
+
+    return revset_info
+
+
+def get_max_commits():
+    return current_app.config.get('TRANSPLANT_MAX_COMMITS', DEFAULT_MAX_COMMITS)
+
+
+def limited_log(repository, revset):
+    # there's no need to read more than one commit above the limit
+    max_commits = get_max_commits()
+    commits = optimistic_log(repository, revset, limit=max_commits + 1)
+    if len(commits) > max_commits:
+        msg = too_many_commits_error(max_commits)
         raise TooManyCommitsError(msg)
 
-    return rest.RevsetInfo(commits=commits)
+    return commits
 
 
-def optimistic_log(repository, revset):
-    try:
-        commits = repository.log(rev=revset)
-    except UnknownRevisionException:
-        # FIXME: the only supported syntax is "rev1 + rev2 + rev3"
-        rev = re.split('\s*\+\s*', revset)
+def optimistic_log(repository, revset, limit=None):
+    # pulling only adds changesets and doesn't touch the working directory,
+    # so it's safe to do it along with other readers
+    with locks.repository_lock(repository.path):
+        try:
+            commits = repository.log(rev=revset, limit=limit)
+        except UnknownRevisionException:
+            # FIXME: the only supported syntax is "rev1 + rev2 + rev3"
+            rev = re.split('\s*\+\s*', revset)
 
-        logger.info('revset "%s" not found in local repository, pulling "%s"',
-                    rev, repository.path)
-        repository.pull(rev=rev, update=True)
-        commits = repository.log(rev=revset)
+            logger.info('revset "%s" not found in local repository, pulling "%s"',
+                        rev, repository.path)
+            pull_revisions(repository, rev)
+            commits = repository.log(rev=revset, limit=limit)
 
     return commits
 
 
-def cleanup(repo):
-    logger.info('cleaning up')
-    repo.update(clean=True)
-    repo.purge(abort_on_err=True, all=True)
+def prepare(src_repo, items):
+    """Pull all revisions referenced by items and missing locally at once.
+
+    Items whose revsets can't be resolved this way are still pulled
+    lazily by optimistic_log.
+    """
+
+    revs = set()
+    for item in items:
+        revset = item.get('commit') or item.get('revset') or ''
+        revs.update(get_node_symbols(revset))
+
+    with stage('prepare'), locks.repository_lock(src_repo.path):
+        missing = find_missing_revisions(src_repo, revs)
+        while missing:
+            logger.info('pulling %d missing revisions into "%s"', len(missing), src_repo.path)
+            try:
+                pull_revisions(src_repo, missing)
+                return
+            except MercurialException, e:
+                unknown = UNKNOWN_REVISION_RE.search(e.stderr)
+                if unknown is None or unknown.group(1) not in missing:
+                    raise e
+
+                # only looked like a changeset hash, e.g. a tag or a bookmark
+                logger.info('"%s" is not a revision, not pulling it', unknown.group(1))
+                missing.discard(unknown.group(1))
+
+
+def get_node_symbols(revset):
+    """Get the symbols of `revset` that may be (short) changeset hashes.
+
+    Strings and arguments of functions like ``keyword()`` or ``desc()``
+    are skipped, even if they look like hashes.
+    """
+
+    symbols = set()
+    functions = []
+    for match in REVSET_TOKEN_RE.finditer(revset):
+        string, function, opening, closing, symbol = match.groups()
+        if function is not None:
+            functions.append(function)
+        elif opening is not None:
+            functions.append(None)
+        elif closing is not None:
+            if functions:
+                functions.pop()
+        elif symbol is not None and NODE_SYMBOL_RE.match(symbol):
+            if not functions or functions[-1] not in STRING_FUNCTIONS:
+                symbols.add(symbol.lower())
+
+    return symbols
+
+
+def pull_revisions(repository, revs):
+    """Pull `revs` into `repository`, sharing the pull with identical concurrent ones.
+
+    Threads of this process wait for the pull in flight. Other processes wait
+    for its lock file, then pull only the revisions that are still missing.
+    """
+
+    revs = sorted(set(revs))
+
+    def pull():
+        with locks.repository_lock(repository.path + '.pull', exclusive=True):
+            missing = find_missing_revisions(repository, revs)
+            if not missing:
+                logger.info('revisions were pulled into "%s" in the meantime', repository.path)
+                return
+
+            repository.pull(rev=sorted(missing))
+            update_commit_index(repository)
+
+    _single_flight.do(('pull', repository.path, tuple(revs)), pull)
+
+
+def pin_items(src, items):
+    """Prepare the source repository once for transplanting `items` to several destinations.
+
+    Revsets of items are resolved to full changeset hashes, so transplants
+    to each destination neither pull nor search the source repository again.
+    """
+
+    src_repo = clone(src)
+    with locks.repository_lock(src_repo.path):
+        prepare(src_repo, items)
+
+        pinned = []
+        for item in items:
+            pinned_item = dict(item)
+            for key in ('commit', 'revset'):
+                if not item.get(key):
+                    continue
+
+                commits = limited_log(src_repo, item[key])
+                if commits:
+                    pinned_item[key] = ' + '.join(commit.node for commit in commits)
+
+            pinned.append(pinned_item)
+
+        if get_transfer_mode() == 'patch':
+            prefetch_patches(src_repo, pinned)
+
+    return pinned
+
+
+def find_missing_revisions(repository, revs):
+    """Get those of `revs` that don't resolve in `repository`."""
+
+    if not revs:
+        return set()
+
+    revset = ' or '.join('present({})'.format(rev) for rev in sorted(revs))
+    nodes = [commit.node for commit in repository.log(rev=revset)]
+    missing = set(rev for rev in revs if not any(node.startswith(rev) for node in nodes))
+
+    # tags, bookmarks and revision numbers may look like hashes too
+    return set(rev for rev in missing if not repository.log(rev='present({})'.format(rev)))
+
+
+def get_parent(repo):
+    # unlike `hg id`, doesn't walk the working directory to check if it's dirty
+    return repo.log(rev='.')[0].node
+
+
+def get_touched_files(src_repo, items):
+    """Get the files that transplanting `items` may have touched, or None if unknown."""
+
+    revs = [item.get('commit') or item.get('revset') for item in items]
+    revs = [rev for rev in revs if rev]
+    if not revs:
+        return None
 
     try:
-        repo.strip('outgoing(default)', no_backup=True)
+        return src_repo.files(revs)
+    except (UnknownRevisionException, MercurialException):
+        return None
+
+
+def get_purge_patterns(touched):
+    """Match touched files along with .rej and .orig files left next to them.
+
+    Returns None if the whole working directory has to be purged.
+    """
+
+    if not touched or len(touched) > MAX_PURGE_PATTERNS:
+        return None
+
+    patterns = []
+    for path in sorted(touched):
+        escaped = GLOB_SPECIAL_RE.sub(lambda m: '\\' + m.group(0), path)
+        patterns.extend(['path:' + path, 'glob:' + escaped + '.*'])
+
+    return patterns
+
+
+def is_pristine(repo, base, completed):
+    """Check whether a job has left the working copy clean, without walking it."""
+
+    if repo.is_transplanting() or repo.is_rebasing():
+        return False
+
+    # a completed job has committed and pushed everything it has changed
+    if completed:
+        return True
+
+    # nothing was committed, and nothing was applied, as a failed transplant leaves its journal
+    return get_parent(repo).startswith(base)
+
+
+def cleanup(repo, base, completed=False, touched=None):
+    with stage('cleanup'), locks.repository_lock(repo.path, exclusive=True):
+        if is_pristine(repo, base, completed):
+            logger.info('working copy "%s" is clean, skipping cleanup', repo.path)
+            return
+
+        logger.info('cleaning up')
+        repo.update(clean=True)
+        repo.forget_transplant()
+        repo.purge(abort_on_err=True, all=True, patterns=get_purge_patterns(touched))
+
+        try:
+            repo.strip('outgoing(default)', no_backup=True)
+        except MercurialException, e:
+            if 'empty revision set' not in e.stderr:
+                raise e
+
+
+def get_dirty_stamp_path(repo):
+    return repo.path + '.dirty'
+
+
+def discard_leftovers(repo, leftovers, update=True):
+    """Clean up after a job that couldn't, because its worker was killed.
+
+    Such a job leaves a stamp behind. Its changesets (`leftovers`) may have been made public
+    by pulling from the source, so they would pass for upstream ones and become a part
+    of the next job (or of its base, if it resumes from a checkpoint).
+    """
+
+    if not os.path.exists(get_dirty_stamp_path(repo)):
+        return
+
+    logger.warning('cleaning up after an interrupted job in "%s"', repo.path)
+    with stage('cleanup'):
+        repo.update(clean=True, rev='.')
+        repo.forget_transplant()
+        repo.purge(abort_on_err=True, all=True)
+        try:
+            repo.strip(leftovers, no_backup=True)
+        except MercurialException, e:
+            if 'empty revision set' not in e.stderr:
+                raise e
+
+        if update:
+            repo.update(clean=True)
+
+    os.unlink(get_dirty_stamp_path(repo))
+
+
+def raw_transplant(repository, source, revset, message=None):
+    return repository.transplant(revset, source=source, message=message)
+
+
+def transplant(src, dst, items):
+    # make sure both repositories are cloned before locking,
+    # as cloning requires an exclusive lock
+    clone(src)
+    clone(dst)
+
+    if get_push_coalescing_window() > 0:
+        return transplant_coalesced(src, dst, items)
+
+    checkpoint = get_checkpoint(src, dst, items)
+    with checkpoint_lock(checkpoint):
+        if get_working_copies_count() > 0:
+            return transplant_shared(src, dst, items, checkpoint)
+
+        return transplant_main(src, dst, items, checkpoint)
+
+
+def transplant_main(src, dst, items, checkpoint=None):
+    # the whole job mutates dst, while src is only read (or pulled into)
+    repo_locks = {
+        get_repo_dir(src): False,
+        get_repo_dir(dst): True
+    }
+
+    with locks.repository_locks(repo_locks):
+        src_repo = clone(src)
+        prepare(src_repo, items)
+        report_progress('prepared')
+        with stage('pull'):
+            dst_repo = clone(dst, force_update=True)
+        discard_leftovers(dst_repo, 'outgoing(default)')
+        report_progress('pulled')
+        base = get_parent(dst_repo)
+
+        tip = get_pushed_tip(dst_repo, checkpoint, items)
+        if tip is not None:
+            return {'tip': tip}
+
+        # removed after cleanup, so it's only left behind by a killed worker
+        open(get_dirty_stamp_path(dst_repo), 'w').close()
+        completed = False
+        try:
+            transplant_items(src_repo, dst_repo, items, checkpoint)
+            push(dst, dst_repo, base)
+            completed = True
+            if checkpoint is not None:
+                checkpoint.reset()
+
+            tip = dst_repo.id(id=True)
+            logger.info('tip: %s', tip)
+            return {'tip': tip}
+
+        finally:
+            touched = None if completed else get_touched_files(src_repo, items)
+            cleanup(dst_repo, base, completed=completed, touched=touched)
+            os.unlink(get_dirty_stamp_path(dst_repo))
+
+
+def push(dst, dst_repo, base):
+    with stage('push'):
+        logger.info('pushing "%s"', dst)
+        try:
+            dst_repo.push()
+        except MercurialException, e:
+            # the pull may have been skipped, as the mirror was fresh enough
+            if 'push creates new remote head' not in e.stderr:
+                raise e
+
+            rebase_on_upstream(dst, dst_repo, base)
+            logger.info('pushing "%s" again', dst)
+            dst_repo.push()
+
+    report_progress('pushed')
+
+
+def get_push_coalescing_window():
+    return current_app.config.get('TRANSPLANT_PUSH_COALESCING', DEFAULT_PUSH_COALESCING)
+
+
+def get_spool(name):
+    return JobSpool(get_repo_dir(name) + '.spool')
+
+
+def transplant_coalesced(src, dst, items):
+    """Queue a job for `dst` and wait until it's pushed along with other queued jobs.
+
+    Whichever task locks `dst` first applies all jobs queued so far in order
+    and pushes them at once, the other tasks just pick up their results.
+    """
+
+    spool = get_spool(dst)
+    with locks.repository_lock(spool.path, exclusive=True):
+        job_id = spool.add({'src': src, 'items': items}, key=get_job_fingerprint(src, dst, items))
+    report_progress('queued')
+
+    # give jobs for the same destination a chance to pile up
+    time.sleep(get_push_coalescing_window())
+
+    # jobs queued later than this point are left for the next task
+    jobs = spool.pending()
+    repo_locks = dict((get_repo_dir(job['src']), False) for _, job in jobs)
+    repo_locks[get_repo_dir(src)] = False
+    repo_locks[get_repo_dir(dst)] = True
+
+    with locks.repository_locks(repo_locks):
+        result = spool.get_result(job_id)
+        if result is None:
+            # sources of jobs queued meanwhile might not be locked
+            jobs = [(i, job) for i, job in spool.pending()
+                    if get_repo_dir(job['src']) in repo_locks]
+            apply_jobs(dst, jobs, reporting_job_id=job_id)
+            spool.prune(SPOOL_RESULT_MAX_AGE)
+            result = spool.get_result(job_id)
+
+    if 'error' in result:
+        raise TransplantError(result['error'])
+
+    return result
+
+
+def apply_jobs(dst, jobs, reporting_job_id=None):
+    """Apply queued jobs one after another and push them together.
+
+    A failed job is rolled back without affecting the ones applied before it.
+    Progress is only reported for items of job `reporting_job_id`.
+    """
+
+    spool = get_spool(dst)
+    progress = getattr(g, 'transplant_progress', None)
+    finished = set()
+
+    def finish(job_id, result):
+        spool.set_result(job_id, result)
+        finished.add(job_id)
+
+    try:
+        with stage('pull'):
+            dst_repo = clone(dst, force_update=True)
+        report_progress('pulled')
+        base = get_parent(dst_repo)
+
+        # (job id, number of changesets it created)
+        applied = []
+        completed = False
+        try:
+            for job_id, job in jobs:
+                job_base = get_parent(dst_repo)
+                src_repo = clone(job['src'])
+                try:
+                    callback = progress if job_id == reporting_job_id else None
+                    with reporting_progress(callback):
+                        prepare(src_repo, job['items'])
+                        transplant_items(src_repo, dst_repo, job['items'])
+                except Exception, e:
+                    logger.warning('job %s failed: %s', job_id, e)
+                    rollback(dst_repo, job_base, get_touched_files(src_repo, job['items']))
+                    finish(job_id, {'error': str(e)})
+                    continue
+
+                count = len(dst_repo.log(rev='only(., {})'.format(job_base)))
+                applied.append((job_id, count))
+
+            if not applied:
+                return
+
+            logger.info('pushing %d jobs at once', len(applied))
+            push(dst, dst_repo, base)
+            completed = True
+
+            # rebasing on upstream may have changed the nodes, but not their order
+            remaining = sum(count for _, count in applied)
+            for job_id, count in applied:
+                remaining -= count
+                tip = dst_repo.log(rev='.~{}'.format(remaining))[0].node[:12]
+                logger.info('job %s tip: %s', job_id, tip)
+                finish(job_id, {'tip': tip})
+
+        finally:
+            cleanup(dst_repo, base, completed=completed)
+
+    except Exception, e:
+        for job_id, _ in jobs:
+            if job_id not in finished:
+                finish(job_id, {'error': str(e)})
+        raise
+
+
+def transplant_shared(src, dst, items, checkpoint=None):
+    working_copies = get_working_copy_dirs(dst)
+
+    with locks.repository_lock(get_repo_dir(src)):
+        with locks.any_repository_lock(working_copies) as repo_dir:
+            src_repo = clone(src)
+            prepare(src_repo, items)
+            report_progress('prepared')
+            dst_repo = share(dst, repo_dir)
+
+            # the store is shared with other working copies,
+            # Mercurial takes care of concurrent pulls
+            # the upstream head is checked again before pushing
+            if not is_fresh(dst):
+                logger.info('pulling / updating working copy "%s"', repo_dir)
+                with stage('pull'):
+                    dst_repo.pull()
+                    update_commit_index(dst_repo)
+                mark_synced(dst)
+
+            # the store is shared, so only the ancestors of the working copy are its leftovers
+            discard_leftovers(dst_repo, 'outgoing(default) and ::.', update=False)
+            with locks.repository_lock(get_phase_lock_dir(dst_repo), exclusive=True):
+                dst_repo.update(clean=True, rev=get_upstream_head(dst))
+            report_progress('pulled')
+            base = get_parent(dst_repo)
+
+            tip = get_pushed_tip(dst_repo, checkpoint, items)
+            if tip is not None:
+                return {'tip': tip}
+
+            # removed after cleanup, so it's only left behind by a killed worker
+            open(get_dirty_stamp_path(dst_repo), 'w').close()
+            completed = False
+            try:
+                transplant_items(src_repo, dst_repo, items, checkpoint)
+
+                # only one working copy can push at a time
+                with stage('push'), locks.repository_lock(get_push_lock_dir(dst), exclusive=True):
+                    rebase_on_upstream(dst, dst_repo, base)
+
+                    logger.info('pushing "%s" from "%s"', dst, repo_dir)
+                    dst_repo.push(rev='.')
+
+                report_progress('pushed')
+
+                completed = True
+                if checkpoint is not None:
+                    checkpoint.reset()
+
+                tip = dst_repo.id(id=True)
+                logger.info('tip: %s', tip)
+                return {'tip': tip}
+
+            finally:
+                touched = None if completed else get_touched_files(src_repo, items)
+                cleanup_shared(dst_repo, base, completed=completed, touched=touched)
+                os.unlink(get_dirty_stamp_path(dst_repo))
+
+
+def rebase_on_upstream(dst, repo, base):
+    repo.pull()
+    update_commit_index(repo)
+    with locks.repository_lock(get_phase_lock_dir(repo), exclusive=True):
+        upstream = repo.log(rev=get_upstream_head(dst))[0].node
+    if repo.log(rev='{} and ancestors({})'.format(upstream, base)):
+        return
+
+    if not repo.log(rev='only(., {})'.format(base)):
+        return
+
+    logger.info('upstream has moved, rebasing "%s" onto "%s"', repo.path, upstream)
+    repo.rebase(source='roots(only(., {}))'.format(base), dest=upstream)
+
+
+def cleanup_shared(repo, base, completed=False, touched=None):
+    with stage('cleanup'):
+        # the next job updates to the upstream head anyway
+        if is_pristine(repo, base, completed):
+            logger.info('working copy "%s" is clean, skipping cleanup', repo.path)
+            return
+
+        # the store is shared with other working copies,
+        # so only strip the changesets created by this job
+        logger.info('cleaning up "%s"', repo.path)
+        if repo.is_rebasing():
+            repo.rebase(abort=True)
+
+        rollback(repo, base, touched)
+
+
+def rollback(repo, base, touched=None):
+    """Update back to `base` and strip the draft changesets created on top of it."""
+
+    head = get_parent(repo)
+    repo.update(clean=True, rev=base)
+    repo.forget_transplant()
+    repo.purge(abort_on_err=True, all=True, patterns=get_purge_patterns(touched))
+
+    try:
+        repo.strip('only({}, {}) and draft()'.format(head, base), no_backup=True)
     except MercurialException, e:
         if 'empty revision set' not in e.stderr:
             raise e
 
 
-def raw_transplant(repository, source, revset, message=None):
-    filter = None
-    env = os.environ.copy()
+def get_checkpoint(src, dst, items):
+    """Get the checkpoint of the job, or None if checkpoints are disabled.
 
-    if message is not None:
-        filter = TRANSPLANT_FILTER
-        env['TRANSPLANT_MESSAGE'] = message
+    Checkpoints are keyed by what the job does, so the same job resumes
+    whether it's redelivered or submitted again after a failure.
+    """
 
-    return repository.transplant(revset, source=source, filter=filter, env=env)
+    if not current_app.config.get('TRANSPLANT_CHECKPOINTS', DEFAULT_CHECKPOINTS):
+        return None
 
+    workdir = current_app.config.get('TRANSPLANT_WORKDIR', DEFAULT_WORKDIR)
+    path = os.path.join(workdir, '.checkpoints')
+    if not os.path.exists(path):
+        os.makedirs(path)
+    prune_checkpoints(path, CHECKPOINT_MAX_AGE)
+
+    fingerprint = get_job_fingerprint(src, dst, items)
+    return Checkpoint(os.path.join(path, fingerprint), fingerprint)
 
-def transplant(src, dst, items):
-    dst_repo = clone(dst, force_update=True)
 
+def get_job_fingerprint(src, dst, items):
+    return hashlib.sha1(json.dumps([src, dst, items], sort_keys=True)).hexdigest()
+
+
+@contextlib.contextmanager
+def checkpoint_lock(checkpoint):
+    """Lock `checkpoint`, so that identical jobs running at the same time don't share it."""
+
+    if checkpoint is None:
+        yield
+        return
+
+    with locks.repository_lock(checkpoint.path, exclusive=True):
+        # checkpoints are pruned by age, the lock of a running job must look recent
+        os.utime(locks.get_lock_path(checkpoint.path), None)
+        yield
+
+
+def get_pushed_tip(dst_repo, checkpoint, items):
+    """Get the tip of a checkpointed job that has been pushed, but not finished (e.g. killed)."""
+
+    if checkpoint is None or not checkpoint.steps:
+        return None
+
+    last = checkpoint.steps[-1]
+    if last['item'] != len(items) - 1 or last['done'] is not None:
+        return None
+
+    # pushed changesets are public, the ones left behind by a failure are drafts
+    pushed = dst_repo.log(rev='present({}) and public()'.format(last['node']))
+    if not pushed:
+        # a push onto a new upstream head rebases them, which keeps the original node
+        rebased = 'descendants({}) and public() and extra(rebase_source, {})'.format(
+            checkpoint.base, last['node'])
+        pushed = dst_repo.log(rev=rebased)
+    if not pushed:
+        return None
+
+    tip = pushed[0].node[:12]
+    logger.info('job has been pushed already, tip: %s', tip)
+    checkpoint.reset()
+    return tip
+
+
+def resume(dst_repo, checkpoint):
+    """Restore the changesets recorded by a checkpoint, return the first item left to transplant."""
+
+    base = get_parent(dst_repo)
+    checkpoint.start(base)
+    steps = checkpoint.steps
+    if not steps:
+        return 0
+
+    last = steps[-1]
+    logger.info('resuming from checkpoint at item %d', last['item'])
     try:
-        for item in items:
-            transplant_item(src, dst, item)
+        for step in steps:
+            bundle_path = checkpoint.get_bundle_path(step)
+            if bundle_path is not None:
+                dst_repo.unbundle(bundle_path)
 
-        logger.info('pushing "%s"', dst)
-        dst_repo.push()
+        dst_repo.update(clean=True, rev=last['node'])
+    except MercurialException, e:
+        logger.warning('failed to restore checkpoint, starting over: %s', e)
+        dst_repo.update(clean=True, rev=base)
+        checkpoint.reset()
+        checkpoint.start(base)
+        return 0
 
-        tip = dst_repo.id(id=True)
-        logger.info('tip: %s', tip)
-        return {'tip': tip}
+    # same as with hg transplant, changesets have to stay drafts to be rebased or stripped
+    make_draft(dst_repo, 'only({}, {})'.format(last['node'], checkpoint.base))
+    report_progress('resumed', item=last['item'])
 
-    finally:
-        cleanup(dst_repo)
-        pass
+    if last['done'] is None:
+        return last['item'] + 1
+
+    return last['item']
+
+
+def save_checkpoint(dst_repo, checkpoint, item, done=None):
+    """Record the changesets created since the previous step of the checkpoint.
+
+    `done` is the number of commits of a chunked item transplanted so far,
+    or None once the item is finished.
+    """
+
+    node = get_parent(dst_repo)
+    # the partial steps of a finished item are gone, as its commits are collapsed
+    parent = checkpoint.get_last_node(item if done is None else None)
+    bundle_path = None
+    if node != parent:
+        bundle_path = checkpoint.new_bundle_path()
+        dst_repo.bundle(bundle_path, base=parent, rev=node, type='none')
+
+    checkpoint.add_step(item, node, bundle_path, done)
+
+
+def get_chunk_size():
+    return current_app.config.get('TRANSPLANT_CHUNK_SIZE', DEFAULT_CHUNK_SIZE)
 
 
-def transplant_item(src, dst, item):
+def transplant_items(src_repo, dst_repo, items, checkpoint=None):
+    with stage('transplant'):
+        if get_transfer_mode() == 'patch':
+            prefetch_patches(src_repo, items)
+
+        base = get_parent(dst_repo)
+        first = 0
+        if checkpoint is not None:
+            first = resume(dst_repo, checkpoint)
+
+        try:
+            for i in range(first, len(items)):
+                report_progress('item_started', item=i)
+                transplant_item(src_repo, dst_repo, items[i], checkpoint, i)
+                if checkpoint is not None:
+                    save_checkpoint(dst_repo, checkpoint, i)
+
+                report_progress('item_transplanted', item=i)
+
+        finally:
+            # pulling from a publishing source makes the changesets it has in common
+            # with the destination public, including the ones pulled by earlier items
+            # (or chunks), and a failed job only strips drafts when rolling back
+            make_draft(dst_repo, 'only(., {})'.format(base))
+
+
+def transplant_item(src_repo, dst_repo, item, checkpoint=None, index=None):
     if 'commit' in item:
-        transplant_commit(src, dst, item)
+        transplant_commit(src_repo, dst_repo, item)
     elif 'revset' in item:
-        transplant_revset(src, dst, item)
+        transplant_revset(src_repo, dst_repo, item, checkpoint, index)
     else:
         raise TransplantError("unknown item: {}".format(item))
 
 
-def transplant_commit(src, dst, item):
+def transplant_commit(src_repo, dst_repo, item):
     message = item.get('message', None)
-    _transplant(src, dst, item['commit'], message=message)
+    _transplant(src_repo, dst_repo, item['commit'], message=message)
 
 
-def transplant_revset(src, dst, item):
+def transplant_revset(src_repo, dst_repo, item, checkpoint=None, index=None):
     message = item.get('message', None)
 
-    src_repo = clone(src)
-    dst_repo = clone(dst)
-    commits = optimistic_log(src_repo, item['revset'])
+    commits = limited_log(src_repo, item['revset'])
     commits_count = len(commits)
-    if commits_count > MAX_COMMITS:
-        msg = too_many_commits_error(commits_count, MAX_COMMITS)
-        raise TooManyCommitsError(msg)
-
     if commits_count == 0:
         return
 
     if commits_count == 1:
-        _transplant(src, dst, item['revset'], message=message)
+        _transplant(src_repo, dst_repo, item['revset'], message=message)
+    elif get_squash_mode() == 'diff' and squash_revset(src_repo, dst_repo, commits, message):
+        return
     else:
-        old_tip = dst_repo.id(id=True)
-        revset = [commit.node for commit in commits]
-
-        # no need to pass message as we'll override it during collapse anyway
-        _transplant(src, dst, revset)
-
-        collapse_rev = 'descendants(children({}))'.format(old_tip)
+        # a resumed item continues with the same commits, even if the revset has moved
+        info = checkpoint.get_item(index) if checkpoint is not None else None
+        if info is None:
+            info = {
+                'start': get_parent(dst_repo),
+                'nodes': [commit.node for commit in commits],
+                'author': commits[-1].author,
+            }
+            if checkpoint is not None:
+                checkpoint.set_item(index, info)
+
+        # big revsets are transplanted in chunks, so a failed job can resume after the last one
+        nodes = info['nodes']
+        done = checkpoint.get_done(index) if checkpoint is not None else 0
+        chunk_size = get_chunk_size()
+        for offset in range(done, len(nodes), chunk_size):
+            chunk = nodes[offset:offset + chunk_size]
+
+            # no need to pass message as we'll override it during collapse anyway
+            _transplant(src_repo, dst_repo, chunk)
+            if checkpoint is not None:
+                save_checkpoint(dst_repo, checkpoint, index, done=offset + len(chunk))
+
+        # other working copies may have their own children of old tip
+        # in the shared store, so only look at the ancestors of ours
+        collapse_rev = 'only(., {})'.format(info['start'])
         collapse_commits = dst_repo.log(rev=collapse_rev)
 
         # less than two commits were transplanted, no need to squash
         if len(collapse_commits) < 2:
             return
 
+        # the commits keep their authors, who are not the one collapsing them
         logger.info('collapsing "%s"', collapse_rev)
-        last_commit_author = commits[-1].author
-        dst_repo.collapse(rev=collapse_rev, message=message, user=last_commit_author)
+        with stage('collapse'):
+            dst_repo.collapse(rev=collapse_rev, message=message, user=info['author'], force=True)
+        report_progress('collapsed')
 
 
-def _transplant(src, dst, revset, message=None):
-    src_repo = clone(src)
-    dst_repo = clone(dst)
+def get_squash_mode():
+    return current_app.config.get('TRANSPLANT_SQUASH_MODE', DEFAULT_SQUASH_MODE)
+
+
+def squash_revset(src_repo, dst_repo, commits, message=None):
+    """Commit the combined change of a linear revset onto dst at once.
+
+    Returns False if the revset is not linear, so it has to be transplanted and collapsed.
+    """
+
+    nodes = ' + '.join(commit.node for commit in commits)
+    roots = src_repo.log(rev='roots({})'.format(nodes))
+    heads = src_repo.log(rev='heads({})'.format(nodes))
+    if len(roots) != 1 or len(heads) != 1:
+        return False
+
+    root = roots[0].node
+    head = heads[0].node
+    span = src_repo.log(rev='{}::{}'.format(root, head), limit=len(commits) + 1)
+    if set(commit.node for commit in span) != set(commit.node for commit in commits):
+        return False
+
+    if src_repo.log(rev='merge() and ({})'.format(nodes), limit=1):
+        return False
+
+    if message is None:
+        # same as the default message of collapse
+        message = '----------------\n'.join(commit.message + '\n' for commit in span).strip()
+
+    # collapse keeps the author and date of the last commit too
+    author, date = src_repo.raw_log(rev=head, template='{author}\\0{date|hgdate}',
+                                    encoding='utf-8').split('\0')
+
+    patch = src_repo.diff(rev=['p1({})'.format(root), head], git=True)
+    if not patch:
+        logger.info('revset "%s::%s" has no changes, nothing to squash', root, head)
+        return True
+
+    logger.info('squashing "%s::%s" from "%s" into "%s"', root, head, src_repo.path, dst_repo.path)
+    fd, patch_path = tempfile.mkstemp(prefix='transplant-', suffix='.patch')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(patch)
 
+        nodes = [commit.node for commit in commits]
+        import_patches(src_repo, dst_repo, patch_path, nodes,
+                       message=message, user=author, date=date)
+    finally:
+        os.unlink(patch_path)
+
+    return True
+
+
+def _transplant(src_repo, dst_repo, revset, message=None):
     # ensure the source revset is pulled from upstream
-    optimistic_log(src_repo, revset)
+    optimistic_log(src_repo, revset, limit=1)
+
+    logger.info('transplanting "%s" from "%s" to "%s"', revset, src_repo.path, dst_repo.path)
+    if get_transfer_mode() == 'patch':
+        transfer_patches(src_repo, dst_repo, revset, message=message)
+        return
+
+    parent = get_parent(dst_repo)
+
+    # hg transplant pulls changesets whose parent is already in place instead of
+    # applying them as patches, which makes them public along with the drafts
+    # they descend from (e.g. earlier chunks), while they have to stay drafts to be
+    # rebased or stripped, and must not be taken for upstream by other working copies
+    with locks.repository_lock(get_phase_lock_dir(dst_repo)):
+        drafts = ['only(., {})'.format(parent)]
+        drafts.extend('{}::.'.format(root.node)
+                      for root in dst_repo.log(rev='roots(draft() and ::{})'.format(parent)))
+
+        result = raw_transplant(dst_repo, src_repo.path, revset, message=message)
+        logger.debug('hg transplant: %s', result)
+
+        # when hg transplant pulls changesets, it may leave the working directory
+        # at the one before the last, so the next chunk or collapse would miss it
+        node = get_parent(dst_repo)
+        if node != parent:
+            heads = dst_repo.log(rev='heads(descendants({}))'.format(node))
+            if len(heads) == 1 and heads[0].node != node:
+                dst_repo.update(rev=heads[0].node)
+
+        make_draft(dst_repo, ' or '.join(drafts))
+
+
+def make_draft(repo, revset):
+    try:
+        repo.phase('({}) and public()'.format(revset), draft=True, force=True)
+    except MercurialException, e:
+        if 'empty revision set' not in e.stderr:
+            raise e
+
+
+def get_transfer_mode():
+    return current_app.config.get('TRANSPLANT_TRANSFER_MODE', DEFAULT_TRANSFER_MODE)
+
+
+def get_patch_cache():
+    workdir = current_app.config.get('TRANSPLANT_WORKDIR', DEFAULT_WORKDIR)
+    max_size = current_app.config.get('TRANSPLANT_PATCH_CACHE_SIZE', DEFAULT_PATCH_CACHE_SIZE)
+    return PatchCache(os.path.join(workdir, '.cache', 'patches'), max_size)
+
+
+def get_transfer_revset(revset):
+    if isinstance(revset, list):
+        revset = ' + '.join(revset)
+
+    # like hg transplant, apply changesets in revision order and skip merges
+    return 'sort(({}) - merge(), rev)'.format(revset)
+
 
-    logger.info('transplanting "%s" from "%s" to "%s"', revset, src, dst)
-    result = raw_transplant(dst_repo, src_repo.path, revset, message=message)
-    dst_repo.update()
+def prefetch_patches(src_repo, items):
+    """Export changesets of all items from the source repository at once."""
 
-    logger.debug('hg transplant: %s', result)
+    nodes = []
+    for item in items:
+        revset = item.get('commit')
+        if revset is None and get_squash_mode() != 'diff':
+            revset = item.get('revset')
 
+        if not revset:
+            continue
 
-def too_many_commits_error(current, limit):
-    return ("You're trying to transplant {} commits "
-            "which is above {} commits limit").format(current, limit)
+        max_commits = get_max_commits()
+        try:
+            commits = src_repo.log(rev=get_transfer_revset(revset), limit=max_commits + 1)
+        except UnknownRevisionException:
+            # will be pulled and exported when the item is transplanted
+            continue
+
+        if len(commits) > max_commits:
+            continue
+
+        nodes.extend(commit.node for commit in commits if commit.node not in nodes)
+
+    if nodes:
+        get_patch_cache().get(src_repo, nodes)
+
+
+def transfer_patches(src_repo, dst_repo, revset, message=None):
+    """Apply changesets of revset to dst as patches exported from src."""
+
+    nodes = [commit.node for commit in src_repo.log(rev=get_transfer_revset(revset))]
+    if not nodes:
+        return
+
+    paths = get_patch_cache().get(src_repo, nodes)
+    if message is None:
+        import_patches(src_repo, dst_repo, paths, nodes)
+        return
+
+    # cached patches are shared, so rewrite copies of them
+    tmpdir = tempfile.mkdtemp(prefix='transplant-')
+    try:
+        rewritten = []
+        for path in paths:
+            with open(path) as f:
+                patch = f.read()
+
+            rewritten_path = os.path.join(tmpdir, os.path.basename(path))
+            with open(rewritten_path, 'w') as f:
+                f.write(rewrite_patch_message(patch, message))
+
+            rewritten.append(rewritten_path)
+
+        import_patches(src_repo, dst_repo, rewritten, nodes)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def rewrite_patch_message(patch, message):
+    """Replace the message of an exported changeset, keeping lines starting with '#'."""
+
+    if isinstance(message, unicode):
+        message = message.encode('utf-8')
+
+    lines = patch.splitlines(True)
+    header = []
+    while lines and lines[0].startswith('# '):
+        header.append(lines.pop(0))
+
+    kept = []
+    while lines and not lines[0].startswith('diff '):
+        line = lines.pop(0)
+        if line.startswith('#'):
+            kept.append(line)
+
+    return ''.join(header + kept + [message.rstrip('\n') + '\n', '\n'] + lines)
+
+
+def import_patches(src_repo, dst_repo, paths, nodes, **kwargs):
+    try:
+        dst_repo.import_patch(paths, **kwargs)
+    except MercurialException:
+        # unlike hg transplant, hg import doesn't leave a journal behind
+        # when it fails, so revert the partially applied patch right away
+        dst_repo.update(clean=True, rev='.')
+        touched = src_repo.files(nodes)
+        dst_repo.purge(abort_on_err=True, all=True, patterns=get_purge_patterns(touched))
+        raise
+
+
+def too_many_commits_error(limit):
+    return "You're trying to transplant more than {} commits".format(limit)
 
 
 class TransplantError(Exception):
     pass
 
+
 class TooManyCommitsError(Exception):
     pass
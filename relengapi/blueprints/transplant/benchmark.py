@@ -0,0 +1,316 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Benchmarks of transplant operations on generated local repositories.
+
+Nothing here needs network access: the source and destination "remotes"
+are local repositories in a temporary directory.
+"""
+
+import collections
+import contextlib
+import datetime
+import difflib
+import logging
+import os
+import platform
+import random
+import shutil
+import tempfile
+import time
+
+from flask import current_app
+
+from repository import Repository
+
+import actions
+
+logger = logging.getLogger(__name__)
+
+USER = 'Benchmark <benchmark@example.com>'
+LINE_LENGTH = 40
+
+# commits transplanted by each run of a benchmark
+SQUASH_SIZES = (10, 100)
+COMMITS_PER_RUN = 1 + sum(SQUASH_SIZES)
+
+# hg import gets that many patches at once
+IMPORT_BATCH_SIZE = 500
+
+# settings overridden to point transplant at the generated repositories
+BENCHMARK_SETTINGS = ('TRANSPLANT_WORKDIR', 'TRANSPLANT_REPOSITORIES')
+
+
+class RepositoryGenerator(object):
+
+    """Generate repositories with random, but reproducible history.
+
+    Every commit replaces a line in one of `files` files of about `file_size` bytes.
+    Commits are imported as patches in batches, which is way faster than
+    committing them one by one.
+    """
+
+    def __init__(self, files=100, file_size=4096, seed=0):
+        self.files = files
+        self.lines = max(1, file_size // LINE_LENGTH)
+        self.random = random.Random(seed)
+        self.time = 1000000000
+        # file contents (lists of lines) at each commit, by node
+        self.contents = {}
+
+    def generate(self, path, commits, heads=1):
+        """Create a repository at `path` with `commits` commits spread over `heads` heads."""
+
+        repo = Repository.init(path)
+        contents = {}
+        for i in range(self.files):
+            name = self._get_file_name(i)
+            contents[name] = [self._make_line() for _ in range(self.lines)]
+            full_path = os.path.join(path, name)
+            if not os.path.exists(os.path.dirname(full_path)):
+                os.makedirs(os.path.dirname(full_path))
+            with open(full_path, 'w') as f:
+                f.writelines(contents[name])
+
+        repo.commit('Initial commit', addremove=True, user=USER)
+        root = repo.log(rev='.')[0].node
+        self.contents[root] = contents
+
+        # side heads fork off the main line at random points,
+        # except its tip, as that would only make the main line longer
+        main = max(0, commits - 1 - (heads - 1) * ((commits - 1) // heads))
+        nodes = [root] + self.extend(repo, root, main)
+        for _ in range(heads - 1):
+            fork = self.random.choice(nodes[:-1] or nodes)
+            self.extend(repo, fork, (commits - 1) // heads)
+
+        repo.update(clean=True, rev=nodes[-1])
+        return repo
+
+    def extend(self, repo, parent, count):
+        """Add a line of `count` commits on top of `parent`, return their nodes."""
+
+        if count <= 0:
+            return []
+
+        contents = dict(self.contents[parent])
+        snapshots = []
+        patch_dir = tempfile.mkdtemp(prefix='patches-', dir=os.path.dirname(repo.path))
+        try:
+            repo.update(clean=True, rev=parent)
+            paths = []
+            for i in range(count):
+                paths.append(os.path.join(patch_dir, '{:06d}.patch'.format(i)))
+                with open(paths[-1], 'w') as f:
+                    f.write(self._make_patch(contents, i))
+                # unchanged files share their lines, so snapshots are cheap
+                snapshots.append(dict(contents))
+
+            for i in range(0, count, IMPORT_BATCH_SIZE):
+                repo.import_patch(paths[i:i + IMPORT_BATCH_SIZE])
+        finally:
+            shutil.rmtree(patch_dir, ignore_errors=True)
+
+        revset = 'sort(only(., {}), rev)'.format(parent)
+        nodes = [commit.node for commit in repo.log(rev=revset)]
+        self.contents.update(zip(nodes, snapshots))
+        return nodes
+
+    def _make_patch(self, contents, i):
+        name = self._get_file_name(self.random.randrange(self.files))
+        old = contents[name]
+        new = list(old)
+        new[self.random.randrange(len(new))] = self._make_line()
+        contents[name] = new
+
+        self.time += 60
+        header = '# HG changeset patch\n# User {}\n# Date {} 0\n\nChange {} of {}\n\n'.format(
+            USER, self.time, i, name)
+        diff = difflib.unified_diff(old, new, 'a/' + name, 'b/' + name)
+        return header + ''.join(diff)
+
+    def _get_file_name(self, i):
+        return 'dir{}/file{}.txt'.format(i % 10, i)
+
+    def _make_line(self):
+        text = '{:x}'.format(self.random.getrandbits(4 * (LINE_LENGTH - 1)))
+        return text.rjust(LINE_LENGTH - 1, '0')[:LINE_LENGTH - 1] + '\n'
+
+
+@contextlib.contextmanager
+def overridden_config(config):
+    previous = dict((key, current_app.config.get(key)) for key in config)
+    missing = [key for key in config if key not in current_app.config]
+    current_app.config.update(config)
+    try:
+        yield
+    finally:
+        current_app.config.update(previous)
+        for key in missing:
+            del current_app.config[key]
+
+
+def summarize(durations):
+    durations = sorted(durations)
+    return {
+        'runs': durations,
+        'min': durations[0],
+        'median': durations[len(durations) // 2],
+        'max': durations[-1],
+    }
+
+
+def get_hg_version():
+    return Repository.command(['--version', '--quiet']).strip()
+
+
+def run(commits=1000, files=100, file_size=4096, heads=1, repeat=3, seed=0, progress=None):
+    """Generate repositories and time transplant operations on them.
+
+    `progress` is called with the benchmark name, run number, number of runs
+    and the duration of each run. Returns machine-readable results, including
+    the transplant settings in effect, so runs with different settings can be compared.
+    """
+
+    basedir = tempfile.mkdtemp(prefix='transplant-benchmark-')
+    try:
+        return _run(basedir, commits, files, file_size, heads, repeat, seed, progress)
+    finally:
+        shutil.rmtree(basedir, ignore_errors=True)
+
+
+def _run(basedir, commits, files, file_size, heads, repeat, seed, progress):
+    results = collections.OrderedDict()
+
+    def timed(name, fn, runs=repeat):
+        durations = []
+        for i in range(runs):
+            start = time.time()
+            fn(i)
+            durations.append(time.time() - start)
+            if progress is not None:
+                progress(name, i + 1, runs, durations[-1])
+
+        results[name] = summarize(durations)
+
+    src_dir = os.path.join(basedir, 'src')
+    dst_dir = os.path.join(basedir, 'dst')
+    work_dir = os.path.join(basedir, 'dst-work')
+
+    logger.info('generating repositories in %s', basedir)
+    start = time.time()
+    generator = RepositoryGenerator(files=files, file_size=file_size, seed=seed)
+    src = generator.generate(src_dir, commits, heads)
+    base = src.log(rev='.')[0].node
+
+    # the destination has a commit of its own, so transplants apply patches instead of pulling
+    dst = Repository.clone(src_dir, work_dir, rev=base)
+    with open(os.path.join(work_dir, 'destination.txt'), 'w') as f:
+        f.write('destination\n')
+    dst.commit('Destination commit', addremove=True, user=USER)
+    Repository.clone(work_dir, dst_dir, noupdate=True)
+    shutil.rmtree(work_dir)
+
+    pending = generator.extend(src, base, repeat * COMMITS_PER_RUN)
+    generate_duration = time.time() - start
+
+    def take(count):
+        taken = pending[:count]
+        del pending[:count]
+        return taken
+
+    settings = dict((key, value) for key, value in current_app.config.iteritems()
+                    if key.startswith('TRANSPLANT_') and key not in BENCHMARK_SETTINGS)
+    config = {
+        'TRANSPLANT_WORKDIR': os.path.join(basedir, 'work'),
+        'TRANSPLANT_REPOSITORIES': [
+            {'name': 'benchmark-src', 'path': src_dir},
+            {'name': 'benchmark-dst', 'path': dst_dir},
+        ],
+    }
+
+    with overridden_config(config):
+        def clone(i):
+            actions.clone('benchmark-src')
+            actions.clone('benchmark-dst')
+
+        timed('clone', clone, runs=1)
+
+        def revset_info_range(i):
+            revset = '{}::{}'.format(pending[0], pending[SQUASH_SIZES[0] - 1])
+            actions.get_revset_info('benchmark-src', revset)
+
+        def revset_info_nodes(i):
+            actions.get_revset_info_cache().clear()
+            revset = ' + '.join(pending[:SQUASH_SIZES[0]])
+            actions.get_revset_info('benchmark-src', revset)
+
+        timed('revset_info_range', revset_info_range)
+        timed('revset_info_nodes', revset_info_nodes)
+
+        def transplant_commit(i):
+            node = take(1)[0]
+            actions.transplant('benchmark-src', 'benchmark-dst', [{'commit': node}])
+
+        timed('transplant_commit', transplant_commit)
+
+        for size in SQUASH_SIZES:
+            def transplant_revset(i, size=size):
+                nodes = take(size)
+                item = {
+                    'revset': '{}::{}'.format(nodes[0], nodes[-1]),
+                    'message': 'Squashed {} commits'.format(size),
+                }
+                actions.transplant('benchmark-src', 'benchmark-dst', [item])
+
+            timed('transplant_revset_{}'.format(size), transplant_revset)
+
+        # push and cleanup are also parts of the transplants above,
+        # time them on their own to tell them apart from applying changes
+        dst_repo = actions.clone('benchmark-dst', force_update=True)
+        durations = {'push': [], 'cleanup': []}
+        for i in range(repeat):
+            with open(os.path.join(dst_repo.path, 'destination.txt'), 'a') as f:
+                f.write('push {}\n'.format(i))
+            dst_repo.commit('Push {}'.format(i), user=USER)
+
+            start = time.time()
+            dst_repo.push()
+            durations['push'].append(time.time() - start)
+            if progress is not None:
+                progress('push', i + 1, repeat, durations['push'][-1])
+
+        for i in range(repeat):
+            base = actions.get_parent(dst_repo)
+            with open(os.path.join(dst_repo.path, 'destination.txt'), 'a') as f:
+                f.write('cleanup {}\n'.format(i))
+            dst_repo.commit('Cleanup {}'.format(i), user=USER)
+            with open(os.path.join(dst_repo.path, 'untracked.txt'), 'w') as f:
+                f.write('untracked\n')
+
+            start = time.time()
+            actions.cleanup(dst_repo, base)
+            durations['cleanup'].append(time.time() - start)
+            if progress is not None:
+                progress('cleanup', i + 1, repeat, durations['cleanup'][-1])
+
+        results['push'] = summarize(durations['push'])
+        results['cleanup'] = summarize(durations['cleanup'])
+
+    return {
+        'time': datetime.datetime.utcnow().isoformat(),
+        'hg': get_hg_version(),
+        'python': platform.python_version(),
+        'parameters': {
+            'commits': commits,
+            'files': files,
+            'file_size': file_size,
+            'heads': heads,
+            'repeat': repeat,
+            'seed': seed,
+        },
+        'settings': settings,
+        'generate': generate_duration,
+        'results': results,
+    }
@@ -0,0 +1,172 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import errno
+import json
+import os
+import shutil
+import time
+
+
+class Checkpoint(object):
+
+    """Progress of one job, so that a rerun of the job resumes where it stopped.
+
+    Progress is a list of steps: either a whole item, or a chunk of commits of an item
+    that are collapsed later. Each step has a bundle of the changesets it created
+    on top of the previous step (or the base of the job), so the job can be restored
+    in any clone of the destination repository.
+    A checkpoint only applies to the job with the same fingerprint.
+    """
+
+    def __init__(self, path, fingerprint):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.state = self._load()
+        if self.state is not None and self.state['fingerprint'] != fingerprint:
+            self.reset()
+
+    @property
+    def base(self):
+        return self.state['base'] if self.state is not None else None
+
+    @property
+    def steps(self):
+        return self.state['steps'] if self.state is not None else []
+
+    def start(self, base):
+        """Start from `base`, unless there's progress to resume."""
+
+        if self.state is None:
+            self.state = {
+                'fingerprint': self.fingerprint,
+                'base': base,
+                'steps': [],
+                'items': {},
+                'bundles': 0,
+            }
+            self._save()
+
+    def reset(self):
+        self.state = None
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def get_last_node(self, item=None):
+        """Get the destination node after the last step, ignoring partial steps of `item`."""
+
+        for step in reversed(self.steps):
+            if step['item'] != item or step['done'] is None:
+                return step['node']
+
+        return self.base
+
+    def get_done(self, item):
+        """Get the number of commits of `item` applied by steps that are still to be collapsed."""
+
+        steps = self.steps
+        if steps and steps[-1]['item'] == item and steps[-1]['done'] is not None:
+            return steps[-1]['done']
+
+        return 0
+
+    def get_item(self, item):
+        return self.state['items'].get(str(item))
+
+    def set_item(self, item, info):
+        """Remember what's needed to finish a chunked item, e.g. its commits."""
+
+        self.state['items'][str(item)] = info
+        self._save()
+
+    def new_bundle_path(self):
+        self._makedirs()
+        self.state['bundles'] += 1
+        return os.path.join(self.path, '{:06d}.hg'.format(self.state['bundles']))
+
+    def get_bundle_path(self, step):
+        return os.path.join(self.path, step['bundle']) if step['bundle'] else None
+
+    def add_step(self, item, node, bundle_path, done=None):
+        """Record a step that has brought the destination to `node`.
+
+        `done` is the number of commits of the item applied so far, or None
+        if the item is finished, which replaces its partial steps.
+        """
+
+        if done is None:
+            self._drop_partial_steps(item)
+
+        self.state['steps'].append({
+            'item': item,
+            'done': done,
+            'node': node,
+            'bundle': os.path.basename(bundle_path) if bundle_path else None,
+        })
+        self._save()
+
+    def _drop_partial_steps(self, item):
+        steps = self.state['steps']
+        while steps and steps[-1]['item'] == item and steps[-1]['done'] is not None:
+            bundle_path = self.get_bundle_path(steps.pop())
+            if bundle_path is not None:
+                _unlink(bundle_path)
+
+        self.state['items'].pop(str(item), None)
+
+    def _load(self):
+        try:
+            with open(os.path.join(self.path, 'state.json')) as f:
+                return json.load(f)
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        except ValueError:
+            # a half-written state can't be trusted
+            return None
+
+    def _save(self):
+        self._makedirs()
+        path = os.path.join(self.path, 'state.json')
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.state, f)
+
+        os.rename(tmp_path, path)
+
+    def _makedirs(self):
+        try:
+            os.makedirs(self.path)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+
+
+def prune_checkpoints(path, max_age):
+    """Remove checkpoints and lock files of jobs that haven't been rerun for `max_age` seconds."""
+
+    if not os.path.exists(path):
+        return
+
+    now = time.time()
+    for name in os.listdir(path):
+        checkpoint_path = os.path.join(path, name)
+        try:
+            if now - os.path.getmtime(checkpoint_path) <= max_age:
+                continue
+
+            if os.path.isdir(checkpoint_path):
+                shutil.rmtree(checkpoint_path, ignore_errors=True)
+            else:
+                os.unlink(checkpoint_path)
+        except OSError:
+            pass
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
@@ -0,0 +1,196 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import logging
+import os
+import struct
+import subprocess
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class CommandServer(object):
+
+    """A long-lived ``hg serve --cmdserver pipe`` process bound to one repository.
+
+    See http://mercurial.selenic.com/wiki/CommandServer for the protocol.
+    """
+
+    def __init__(self, cmd, path, config=None):
+        self.path = path
+
+        args = [cmd]
+        if config:
+            args.extend(config)
+        args.extend(['serve', '--cmdserver', 'pipe', '--repository', path])
+
+        self.devnull = open(os.devnull, 'w')
+        try:
+            self.process = subprocess.Popen(
+                args, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=self.devnull, cwd=path, close_fds=True)
+        except OSError, e:
+            self.devnull.close()
+            raise CommandServerError(path, 'failed to start: {}'.format(e))
+
+        try:
+            self.capabilities, self.encoding = self._read_hello()
+        except CommandServerError:
+            self.close()
+            raise
+
+    def is_alive(self):
+        return self.process.poll() is None
+
+    def runcommand(self, args):
+        # the protocol is byte-oriented, don't let unicode arguments spoil encoded ones
+        data = '\0'.join(arg.encode('utf-8') if isinstance(arg, unicode) else arg
+                         for arg in args)
+        try:
+            self.process.stdin.write('runcommand\n')
+            self._write_block(data)
+        except IOError, e:
+            raise CommandServerError(self.path, 'write failed: {}'.format(e))
+
+        stdout = []
+        stderr = []
+        while True:
+            channel, data = self._read_channel()
+            if channel == 'o':
+                stdout.append(data)
+            elif channel == 'e':
+                stderr.append(data)
+            elif channel == 'r':
+                returncode = struct.unpack('>i', data)[0]
+                return returncode, ''.join(stdout), ''.join(stderr)
+            elif channel in 'IL':
+                # we never feed input to commands, reply with EOF
+                self._write_block('')
+            elif channel.isupper():
+                raise CommandServerError(
+                    self.path, 'unexpected required channel: {}'.format(channel))
+            # unknown optional channels (e.g. debug output) are ignored
+
+    def close(self):
+        try:
+            if self.is_alive():
+                self.process.stdin.close()
+                self.process.wait()
+        except (IOError, OSError), e:
+            logger.warning('failed to close command server for "%s": %s', self.path, e)
+        finally:
+            self.devnull.close()
+
+    def _read_hello(self):
+        channel, data = self._read_channel()
+        if channel != 'o':
+            raise CommandServerError(self.path, 'unexpected hello channel: {}'.format(channel))
+
+        fields = {}
+        for line in data.splitlines():
+            if ': ' in line:
+                key, value = line.split(': ', 1)
+                fields[key] = value
+
+        capabilities = fields.get('capabilities', '').split()
+        if 'runcommand' not in capabilities:
+            raise CommandServerError(self.path, 'runcommand capability is not supported')
+
+        return capabilities, fields.get('encoding')
+
+    def _read_channel(self):
+        header = self._read(5)
+        channel, length = struct.unpack('>cI', header)
+        if channel in 'IL':
+            return channel, length
+
+        return channel, self._read(length)
+
+    def _read(self, size):
+        try:
+            data = self.process.stdout.read(size)
+        except IOError, e:
+            raise CommandServerError(self.path, 'read failed: {}'.format(e))
+
+        if len(data) != size:
+            raise CommandServerError(self.path, 'terminated unexpectedly')
+
+        return data
+
+    def _write_block(self, data):
+        self.process.stdin.write(struct.pack('>I', len(data)))
+        self.process.stdin.write(data)
+        self.process.stdin.flush()
+
+
+class CommandServerPool(object):
+
+    """Idle command servers, keyed by repository path."""
+
+    def __init__(self, cmd, config=None, max_idle=2):
+        self.cmd = cmd
+        self.config = config or []
+        self.max_idle = max_idle
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.idle = {}
+
+    def acquire(self, path):
+        with self.lock:
+            self._check_pid()
+            servers = self.idle.get(path, [])
+            while servers:
+                server = servers.pop()
+                if server.is_alive():
+                    return server
+
+                server.close()
+
+        logger.debug('starting command server for "%s"', path)
+        return CommandServer(self.cmd, path, config=self.config)
+
+    def release(self, server):
+        with self.lock:
+            self._check_pid()
+            servers = self.idle.setdefault(server.path, [])
+            if server.is_alive() and len(servers) < self.max_idle:
+                servers.append(server)
+                return
+
+        server.close()
+
+    def invalidate(self, path):
+        """Stop idle servers for a path, e.g. after its hgrc was changed."""
+        with self.lock:
+            servers = self.idle.pop(path, [])
+
+        for server in servers:
+            server.close()
+
+    def close(self):
+        with self.lock:
+            idle = self.idle
+            self.idle = {}
+
+        for servers in idle.itervalues():
+            for server in servers:
+                server.close()
+
+    def _check_pid(self):
+        # servers inherited from a parent process (e.g. a forked Celery worker)
+        # share their pipes with the parent, so never reuse them
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.idle = {}
+
+
+class CommandServerError(Exception):
+    def __init__(self, path, reason):
+        self.path = path
+        self.reason = reason
+        Exception.__init__(self, path, reason)
+
+    def __str__(self):
+        return 'command server for "{}": {}'.format(self.path, self.reason)
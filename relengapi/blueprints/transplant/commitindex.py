@@ -0,0 +1,122 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import contextlib
+import logging
+import sqlite3
+
+from repository import UnknownRevisionException
+
+import rest
+
+logger = logging.getLogger(__name__)
+
+
+class CommitIndex(object):
+
+    """On-disk node -> CommitInfo index of public changesets of one repository.
+
+    Only public changesets are indexed, as drafts can be stripped.
+    """
+
+    batch_size = 1000
+
+    def __init__(self, path):
+        self.path = path
+
+    def lookup(self, revs):
+        """Get commits by (short) nodes, or None if any of them is unknown or ambiguous."""
+
+        commits = []
+        with self._connect() as connection:
+            for rev in revs:
+                # all nodes starting with rev, as hex digits sort before 'g'
+                rows = connection.execute(
+                    'SELECT node, date, author, message FROM commits '
+                    'WHERE node >= ? AND node < ? LIMIT 2',
+                    (rev, rev + 'g')
+                ).fetchall()
+
+                if len(rows) != 1:
+                    return None
+
+                node, date, author, message = rows[0]
+                commits.append(rest.CommitInfo(
+                    node=node,
+                    date=date,
+                    author=author,
+                    message=message
+                ))
+
+        return commits
+
+    def update(self, repository):
+        """Index public changesets that appeared since the last update."""
+
+        with self._connect() as connection:
+            last_node = self._get_meta(connection, 'last_node')
+            if last_node is None:
+                return self._index(connection, repository, 'public()')
+
+            revset = 'public() and ({0}: and not {0})'.format(last_node)
+            try:
+                return self._index(connection, repository, revset)
+            except UnknownRevisionException:
+                # the repository was re-cloned, start over
+                logger.info('last indexed node of "%s" is gone, reindexing', repository.path)
+                return self._index(connection, repository, 'public()')
+
+    def _index(self, connection, repository, revset):
+        count = 0
+        last_node = None
+        batch = []
+        for commit in repository.iter_log(rev=revset):
+            batch.append((commit.node, commit.date, commit.author, commit.message))
+            last_node = commit.node
+            if len(batch) >= self.batch_size:
+                count += self._insert(connection, batch)
+                batch = []
+
+        count += self._insert(connection, batch)
+        if last_node is not None:
+            self._set_meta(connection, 'last_node', last_node)
+
+        connection.commit()
+        if count:
+            logger.info('indexed %d commits of "%s"', count, repository.path)
+
+        return count
+
+    def _insert(self, connection, batch):
+        connection.executemany(
+            'INSERT OR REPLACE INTO commits (node, date, author, message) VALUES (?, ?, ?, ?)',
+            batch
+        )
+        return len(batch)
+
+    def _get_meta(self, connection, key):
+        row = connection.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+
+        return row[0]
+
+    def _set_meta(self, connection, key, value):
+        connection.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+
+    @contextlib.contextmanager
+    def _connect(self):
+        # concurrent writers from other processes wait for each other
+        connection = sqlite3.connect(self.path, timeout=30)
+        try:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS commits ('
+                'node TEXT PRIMARY KEY, date TEXT, author TEXT, message TEXT)'
+            )
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)'
+            )
+            yield connection
+        finally:
+            connection.close()
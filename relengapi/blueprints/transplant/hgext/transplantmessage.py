@@ -0,0 +1,45 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+'''override messages of transplanted changesets without an external filter
+
+Run ``hg transplant --filter transplantmessage`` with
+``--config transplantmessage.message=MESSAGE`` to replace the message of every
+transplanted changeset with MESSAGE. Message lines starting with ``#`` are kept,
+just like an external filter that rewrites the message file would do.
+'''
+
+import cStringIO
+
+from mercurial import extensions
+from mercurial import util
+from mercurial.i18n import _
+
+FILTER = 'transplantmessage'
+
+
+def filter(orig, self, filter, node, changelog, patchfile):
+    if filter != FILTER:
+        return orig(self, filter, node, changelog, patchfile)
+
+    message = self.ui.config('transplantmessage', 'message')
+    if message is None:
+        raise util.Abort(_('transplantmessage.message is not set'))
+
+    user, date, msg = (changelog[1], changelog[2], changelog[4])
+    lines = [
+        '# HG changeset patch\n',
+        '# User %s\n' % user,
+        '# Date %d %d\n' % date,
+    ]
+    lines.extend(line for line in (msg + '\n').splitlines(True) if line.startswith('#'))
+    lines.append(message)
+
+    # parse it the same way as a message file rewritten by an external filter
+    return self.parselog(cStringIO.StringIO(''.join(lines)))[1:4]
+
+
+def extsetup(ui):
+    transplant = extensions.find('transplant')
+    extensions.wrapfunction(transplant.transplanter, 'filter', filter)
@@ -0,0 +1,151 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import contextlib
+import errno
+import fcntl
+import logging
+import random
+import threading
+
+logger = logging.getLogger(__name__)
+
+_state = threading.local()
+
+
+class _HeldLock(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'a')
+        self.modes = []
+
+    @property
+    def exclusive(self):
+        return any(self.modes)
+
+    def flock(self, exclusive, blocking=True):
+        operation = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+        try:
+            fcntl.flock(self.file, operation | fcntl.LOCK_NB)
+            return True
+        except IOError, e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+
+        if not blocking:
+            return False
+
+        logger.info('waiting for %s lock "%s"',
+                    'exclusive' if exclusive else 'shared', self.path)
+        fcntl.flock(self.file, operation)
+        return True
+
+    def release(self):
+        fcntl.flock(self.file, fcntl.LOCK_UN)
+        self.file.close()
+
+
+def get_lock_path(repository_dir):
+    return repository_dir + '.lock'
+
+
+def _held_locks():
+    if not hasattr(_state, 'locks'):
+        _state.locks = {}
+
+    return _state.locks
+
+
+def _acquire(repository_dir, exclusive, blocking=True):
+    held = _held_locks()
+    entry = held.get(repository_dir)
+    if entry is None:
+        entry = _HeldLock(get_lock_path(repository_dir))
+        held[repository_dir] = entry
+
+    if not entry.modes or (exclusive and not entry.exclusive):
+        # a failed non-blocking upgrade would drop the shared lock,
+        # so upgrades are always blocking
+        locked = False
+        try:
+            locked = entry.flock(exclusive, blocking=blocking or bool(entry.modes))
+        finally:
+            if not locked and not entry.modes:
+                entry.file.close()
+                del held[repository_dir]
+
+        if not locked:
+            return False
+
+    entry.modes.append(exclusive)
+    return True
+
+
+def _release(repository_dir):
+    held = _held_locks()
+    entry = held[repository_dir]
+    exclusive = entry.modes.pop()
+    if not entry.modes:
+        entry.release()
+        del held[repository_dir]
+    elif exclusive and not entry.exclusive:
+        entry.flock(False)
+
+
+@contextlib.contextmanager
+def repository_lock(repository_dir, exclusive=False):
+    """Lock a repository directory, either shared (read) or exclusive (write).
+
+    Locks are re-entrant within a thread: nested exclusive lock upgrades
+    the shared one and downgrades it back on exit. Note that flock() upgrades
+    are not atomic, the shared lock is dropped before waiting for exclusive one.
+    """
+
+    _acquire(repository_dir, exclusive)
+    try:
+        yield
+    finally:
+        _release(repository_dir)
+
+
+@contextlib.contextmanager
+def repository_locks(repository_dirs):
+    """Lock several repository directories at once.
+
+    `repository_dirs` maps a directory to whether it should be locked exclusively.
+    Locks are always acquired in the same order to avoid deadlocks between jobs
+    that use the same pair of repositories in opposite directions.
+    """
+
+    if not repository_dirs:
+        yield
+        return
+
+    dirs = sorted(repository_dirs)
+    first = dirs[0]
+    rest = dict((d, repository_dirs[d]) for d in dirs[1:])
+    with repository_lock(first, exclusive=repository_dirs[first]):
+        with repository_locks(rest):
+            yield
+
+
+@contextlib.contextmanager
+def any_repository_lock(repository_dirs):
+    """Exclusively lock the first free directory of `repository_dirs` and yield it.
+
+    If all of them are busy, wait for a random one.
+    """
+
+    for repository_dir in repository_dirs:
+        if _acquire(repository_dir, True, blocking=False):
+            break
+    else:
+        repository_dir = random.choice(repository_dirs)
+        _acquire(repository_dir, True)
+
+    try:
+        yield repository_dir
+    finally:
+        _release(repository_dir)
@@ -0,0 +1,195 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import errno
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# seconds, from a quick `hg log` up to a push of a huge repository
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+class Metrics(object):
+
+    """Histograms and counters of one process.
+
+    Celery workers and the web app are separate processes, so each of them
+    periodically saves its metrics to its own file in `path`, and the exporter
+    adds up all of these files. Files of processes that have exited are kept,
+    so the totals never go down.
+    """
+
+    def __init__(self, path, buckets=DEFAULT_BUCKETS, flush_interval=5):
+        self.path = path
+        self.buckets = buckets
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self._reset()
+
+    def observe(self, name, labels, value):
+        """Add a value to histogram `name`."""
+
+        with self.lock:
+            self._check_pid()
+            series = self._get_series(name, 'histogram', labels)
+            # buckets are not cumulative until they're rendered
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['buckets'][i] += 1
+                    break
+            series['sum'] += value
+            series['count'] += 1
+
+        self._maybe_flush()
+
+    def inc(self, name, labels, value=1):
+        """Increase counter `name`."""
+
+        with self.lock:
+            self._check_pid()
+            series = self._get_series(name, 'counter', labels)
+            series['sum'] += value
+
+        self._maybe_flush()
+
+    def flush(self):
+        with self.lock:
+            self._check_pid()
+            if not self.dirty:
+                return
+
+            # other threads keep changing the series
+            data = json.dumps({'buckets': list(self.buckets), 'series': self.series.values()})
+            self.dirty = False
+            self.last_flush = time.time()
+
+        try:
+            write_file(os.path.join(self.path, self.filename), data)
+        except (IOError, OSError), e:
+            logger.warning('failed to save metrics: %s', e)
+
+    def _maybe_flush(self):
+        if time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def _get_series(self, name, kind, labels):
+        key = (name, tuple(sorted(labels.items())))
+        series = self.series.get(key)
+        if series is None:
+            series = {'name': name, 'type': kind, 'labels': dict(labels), 'sum': 0, 'count': 0}
+            if kind == 'histogram':
+                series['buckets'] = [0] * len(self.buckets)
+            self.series[key] = series
+
+        self.dirty = True
+        return series
+
+    def _reset(self):
+        self.pid = os.getpid()
+        # pids are reused, but the metrics of a dead process must not be overwritten
+        self.filename = '{}-{}.json'.format(self.pid, uuid.uuid4().hex)
+        self.series = {}
+        self.dirty = False
+        self.last_flush = 0
+
+    def _check_pid(self):
+        # metrics inherited from a parent process (e.g. a forked Celery worker)
+        # are saved by the parent, so start from scratch
+        if self.pid != os.getpid():
+            self._reset()
+
+
+def write_file(path, data):
+    try:
+        os.makedirs(os.path.dirname(path))
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(data)
+
+    os.rename(tmp_path, path)
+
+
+def collect_metrics(path):
+    """Add up metrics saved by all processes, keyed by (name, labels)."""
+
+    if not os.path.exists(path):
+        return {}
+
+    merged = {}
+    for name in sorted(os.listdir(path)):
+        if not name.endswith('.json'):
+            continue
+
+        try:
+            with open(os.path.join(path, name)) as f:
+                data = json.load(f)
+        except (IOError, ValueError), e:
+            logger.warning('failed to read metrics "%s": %s', name, e)
+            continue
+
+        for series in data['series']:
+            key = (series['name'], tuple(sorted(series['labels'].items())))
+            total = merged.get(key)
+            if total is None:
+                total = merged[key] = dict(series, sum=0, count=0, buckets={})
+
+            total['sum'] += series['sum']
+            total['count'] += series['count']
+
+            for bound, count in zip(data['buckets'], series.get('buckets', [])):
+                total['buckets'][bound] = total['buckets'].get(bound, 0) + count
+
+    return merged
+
+
+def render_metrics(merged):
+    """Render collected metrics in Prometheus text exposition format."""
+
+    lines = []
+    typed = set()
+    for (name, _), series in sorted(merged.iteritems()):
+        if name not in typed:
+            lines.append('# TYPE {} {}'.format(name, series['type']))
+            typed.add(name)
+
+        labels = sorted(series['labels'].items())
+        if series['type'] == 'counter':
+            lines.append('{}{} {}'.format(name, format_labels(labels), series['sum']))
+            continue
+
+        # processes may have used different bounds, so buckets are accumulated only now
+        cumulative = 0
+        for bound, count in sorted(series['buckets'].iteritems()):
+            cumulative += count
+            bucket_labels = labels + [('le', repr(float(bound)))]
+            lines.append('{}_bucket{} {}'.format(name, format_labels(bucket_labels), cumulative))
+
+        inf_labels = labels + [('le', '+Inf')]
+        lines.append('{}_bucket{} {}'.format(name, format_labels(inf_labels), series['count']))
+        lines.append('{}_sum{} {}'.format(name, format_labels(labels), series['sum']))
+        lines.append('{}_count{} {}'.format(name, format_labels(labels), series['count']))
+
+    return ''.join(line + '\n' for line in lines)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+
+    return '{' + ','.join('{}="{}"'.format(key, escape_label(value))
+                          for key, value in labels) + '}'
+
+
+def escape_label(value):
+    return unicode(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
@@ -1,11 +1,30 @@
 import os
+import fcntl
+import contextlib
 import json
 import time
 import tempfile
 import shutil
-from nose.tools import eq_
+import threading
+import mock
+from nose.tools import eq_, assert_raises
 from relengapi.lib.testing.context import TestContext
 from repository import Repository
+from repository import MercurialException
+from singleflight import SingleFlight
+from spool import JobSpool
+from tracing import Trace
+import actions
+import benchmark
+import locks
+import repository
+import tasks
+from cache import LRUCache
+from commandserver import CommandServerPool
+from commitindex import CommitIndex
+from patches import PatchCache
+from metrics import Metrics
+from relengapi import p
 from kombu import Exchange, Queue
 
 test_temp_dir = tempfile.mkdtemp()
@@ -70,13 +89,57 @@ def _wait_until_task_ready(client, task_id, attempts=10, interval=0.5):
     raise RuntimeError('task is not ready after {} attemps'.format(attempts))
 
 
-test_context = TestContext(app_setup=app_setup, config={
+test_config = {
     'CELERY_ACCEPT_CONTENT': ['json'],
     'CELERY_TASK_SERIALIZER': 'json',
     'CELERY_RESULT_SERIALIZER': 'json',
     'CELERY_BROKER_URL': 'redis://localhost:6379/2',
     'CELERY_BACKEND': 'redis://localhost:6379/3',
-})
+}
+
+test_context = TestContext(app_setup=app_setup, config=test_config)
+
+checkpoint_config = dict(test_config,
+                         TRANSPLANT_CHECKPOINTS=True,
+                         TRANSPLANT_CHUNK_SIZE=2)
+checkpoint_context = test_context.specialize(config=checkpoint_config)
+shared_checkpoint_context = test_context.specialize(
+    config=dict(checkpoint_config, TRANSPLANT_WORKING_COPIES=2))
+
+shared_context = test_context.specialize(
+    config=dict(test_config, TRANSPLANT_WORKING_COPIES=2, TRANSPLANT_CHUNK_SIZE=2))
+
+coalescing_context = test_context.specialize(
+    config=dict(test_config, TRANSPLANT_PUSH_COALESCING=1))
+
+revset_context = test_context.specialize(perms=[p.transplant.transplant])
+
+sync_context = test_context.specialize(
+    config=dict(test_config, TRANSPLANT_SYNC_INTERVAL=60, TRANSPLANT_SYNC_MAX_AGE=60))
+
+warm_up_context = test_context.specialize(
+    config=dict(test_config, TRANSPLANT_WARM_UP=True))
+
+diff_squash_context = test_context.specialize(
+    config=dict(test_config, TRANSPLANT_SQUASH_MODE='diff'))
+
+patch_context = test_context.specialize(
+    config=dict(test_config, TRANSPLANT_TRANSFER_MODE='patch'))
+
+worker_context = test_context.specialize(
+    config=dict(test_config, CELERY_ALWAYS_EAGER=False), perms=[p.transplant.transplant])
+
+metrics_context = test_context.specialize(
+    config=dict(test_config, TRANSPLANT_METRICS=True), perms=[p.transplant.metrics])
+
+stream_clone_context = test_context.specialize(
+    config=dict(test_config, TRANSPLANT_STREAM_CLONE=True))
+
+async_lookups_context = worker_context.specialize(
+    config=dict(test_config, CELERY_ALWAYS_EAGER=False, TRANSPLANT_ASYNC_LOOKUPS=True))
+
+commit_index_context = test_context.specialize(
+    config=dict(test_config, TRANSPLANT_COMMIT_INDEX=True))
 
 @test_context
 def test_lookup(app, client):
@@ -130,3 +193,1207 @@ def test_transplant_single_commit(app, client):
     response = _wait_until_task_ready(client, task_id)
 
     eq_(response, '')
+
+
+class _Killed(BaseException):
+    """Stops a job the way a killed worker would."""
+
+
+def _commit_src_files(app, count):
+    nodes = []
+    for i in range(count):
+        with open(os.path.join(app.src_dir, 'file{}.txt'.format(i)), 'w') as f:
+            f.write('file {}\n'.format(i))
+        app.src.commit('add file {}'.format(i), addremove=True, user='Test User')
+        nodes.append(app.src.id(id=True))
+    return nodes
+
+
+def _kill_after_chunks(count):
+    """Make the job die after `count` chunks, without cleaning up."""
+    transplant = actions._transplant
+    calls = []
+
+    def dying_transplant(*args, **kwargs):
+        transplant(*args, **kwargs)
+        calls.append(None)
+        if len(calls) == count:
+            raise _Killed()
+
+    def dying_cleanup(*args, **kwargs):
+        raise _Killed()
+
+    return [
+        mock.patch.object(actions, '_transplant', dying_transplant),
+        mock.patch.object(actions, 'cleanup', dying_cleanup),
+        mock.patch.object(actions, 'cleanup_shared', dying_cleanup),
+    ]
+
+
+def _transplant_killed_and_resumed(app):
+    nodes = _commit_src_files(app, 5)
+    items = [{
+        'revset': '{}::{}'.format(nodes[0], nodes[-1]),
+        'message': 'squashed'
+    }]
+
+    patches = _kill_after_chunks(2)
+    for patch in patches:
+        patch.start()
+    try:
+        with app.app_context():
+            assert_raises(_Killed, actions.transplant,
+                          'test-src', 'test-dst', items)
+    finally:
+        for patch in patches:
+            patch.stop()
+
+    with app.app_context():
+        actions.transplant('test-src', 'test-dst', items)
+
+    messages = [commit_info.message for commit_info in app.dst.log(rev='all()')]
+    eq_(messages, ['Initial commit', 'squashed'])
+
+
+@checkpoint_context
+def test_transplant_resumes_after_killed_worker(app):
+    _transplant_killed_and_resumed(app)
+
+
+@shared_checkpoint_context
+def test_transplant_shared_resumes_after_killed_worker(app):
+    _transplant_killed_and_resumed(app)
+
+
+def _transplant_failed_and_resubmitted(app):
+    nodes = _commit_src_files(app, 5)
+    items = [{
+        'revset': '{}::{}'.format(nodes[0], nodes[-1]),
+        'message': 'squashed'
+    }]
+
+    transplant = actions._transplant
+    chunks = []
+
+    def failing_transplant(*args, **kwargs):
+        chunks.append(None)
+        if len(chunks) == 3:
+            raise RuntimeError('network error')
+        transplant(*args, **kwargs)
+
+    with mock.patch.object(actions, '_transplant', failing_transplant):
+        with app.app_context():
+            assert_raises(RuntimeError, actions.transplant,
+                          'test-src', 'test-dst', items)
+
+        # only the last chunk is left to transplant
+        with app.app_context():
+            actions.transplant('test-src', 'test-dst', items)
+        eq_(len(chunks), 4)
+
+    messages = [commit_info.message for commit_info in app.dst.log(rev='all()')]
+    eq_(messages, ['Initial commit', 'squashed'])
+
+
+@checkpoint_context
+def test_transplant_resubmitted_after_failure_resumes(app):
+    _transplant_failed_and_resubmitted(app)
+
+
+@shared_checkpoint_context
+def test_transplant_shared_resubmitted_after_failure_resumes(app):
+    _transplant_failed_and_resubmitted(app)
+
+
+def _transplant_onto_branch(app):
+    node = _commit_src_files(app, 1)[0]
+
+    # the default branch has moved on since the release branch was made
+    app.dst.local_command(['branch', 'release'])
+    app.dst.commit("Release branch", user="Test User")
+    app.dst.update(rev='default')
+    _set_test_file_content(app.dst_dir, "Hello Default!\n")
+    app.dst.commit("Default change", user="Test User")
+    app.config['TRANSPLANT_REPOSITORIES'][1]['branch'] = 'release'
+
+    with app.app_context():
+        actions.transplant('test-src', 'test-dst', [{'commit': node}])
+
+    messages = [commit_info.message for commit_info in app.dst.log(rev='branch(release)')]
+    eq_(messages, ['Release branch', 'add file 0'])
+    eq_(app.dst.log(rev='max(branch(default))')[0].message, 'Default change')
+
+
+@test_context
+def test_transplant_onto_branch(app):
+    _transplant_onto_branch(app)
+
+
+@shared_context
+def test_transplant_shared_onto_branch(app):
+    _transplant_onto_branch(app)
+
+
+@shared_context
+def test_transplant_shared_keeps_pulled_changesets_drafts(app):
+    base = app.src.log(rev='tip')[0].node
+    nodes = _commit_src_files(app, 5)
+    items = [{
+        'revset': '{}::{}'.format(nodes[0], nodes[-1]),
+        'message': 'squashed'
+    }]
+
+    raw_transplant = actions.raw_transplant
+    transplant = actions._transplant
+    published = []
+
+    def locked_transplant(repository, source, revset, message=None):
+        # other working copies can't look up the upstream head meanwhile
+        assert not _can_lock(actions.get_phase_lock_dir(repository), exclusive=True)
+        return raw_transplant(repository, source, revset, message=message)
+
+    def checked_transplant(src_repo, dst_repo, revset, message=None):
+        transplant(src_repo, dst_repo, revset, message=message)
+        rev = 'only(., {}) and public()'.format(base)
+        published.extend(commit_info.node for commit_info in dst_repo.log(rev=rev))
+
+    with mock.patch.object(actions, 'raw_transplant', locked_transplant), \
+            mock.patch.object(actions, '_transplant', checked_transplant):
+        with app.app_context():
+            actions.transplant('test-src', 'test-dst', items)
+
+    eq_(published, [])
+    messages = [commit_info.message for commit_info in app.dst.log(rev='all()')]
+    eq_(messages, ['Initial commit', 'squashed'])
+
+
+@checkpoint_context
+def test_transplant_resumed_after_rebased_push(app):
+    node = _commit_src_files(app, 1)[0]
+    items = [{'commit': node}]
+
+    push = actions.push
+
+    def pushing_onto_new_head(dst, dst_repo, base):
+        # another push gets in first, so this one has to rebase
+        _set_test_file_content(app.dst_dir, "Hello Upstream!\n")
+        app.dst.commit("Upstream change", user="Test User")
+        push(dst, dst_repo, base)
+        raise _Killed()
+
+    def dying_cleanup(*args, **kwargs):
+        raise _Killed()
+
+    with mock.patch.object(actions, 'push', pushing_onto_new_head), \
+            mock.patch.object(actions, 'cleanup', dying_cleanup):
+        with app.app_context():
+            assert_raises(_Killed, actions.transplant, 'test-src', 'test-dst', items)
+
+    with app.app_context():
+        result = actions.transplant('test-src', 'test-dst', items)
+
+    tip = app.dst.log(rev='tip')[0]
+    eq_(result, {'tip': tip.node[:12]})
+    messages = [commit_info.message for commit_info in app.dst.log(rev='all()')]
+    eq_(messages, ['Initial commit', 'Upstream change', 'add file 0'])
+
+
+def _transplant_task(app):
+    with app.app_context():
+        tasks.configure_acks_on_worker_init(sender=mock.Mock(app=app.celery))
+        return app.celery.tasks['{}.transplant'.format(tasks.__name__)]
+
+
+@test_context
+def test_transplant_acked_early_without_checkpoints(app):
+    eq_(_transplant_task(app).acks_late, False)
+
+
+@checkpoint_context
+def test_transplant_acked_late_with_checkpoints(app):
+    eq_(_transplant_task(app).acks_late, True)
+
+
+def _can_lock(repository_dir, exclusive):
+    """Check whether another process could lock `repository_dir` right now."""
+
+    operation = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+    with open(locks.get_lock_path(repository_dir), 'a') as f:
+        try:
+            fcntl.flock(f, operation | fcntl.LOCK_NB)
+        except IOError:
+            return False
+
+        fcntl.flock(f, fcntl.LOCK_UN)
+        return True
+
+
+def test_repository_lock_upgrade():
+    repository_dir = tempfile.mkdtemp(dir=test_temp_dir)
+
+    with locks.repository_lock(repository_dir):
+        assert _can_lock(repository_dir, exclusive=False)
+        assert not _can_lock(repository_dir, exclusive=True)
+
+        with locks.repository_lock(repository_dir, exclusive=True):
+            assert not _can_lock(repository_dir, exclusive=False)
+
+            # a nested shared lock doesn't downgrade the exclusive one
+            with locks.repository_lock(repository_dir):
+                assert not _can_lock(repository_dir, exclusive=False)
+            assert not _can_lock(repository_dir, exclusive=False)
+
+        # downgraded back to shared
+        assert _can_lock(repository_dir, exclusive=False)
+        assert not _can_lock(repository_dir, exclusive=True)
+
+    assert _can_lock(repository_dir, exclusive=True)
+
+
+def test_repository_locks_reentrant():
+    src_dir = tempfile.mkdtemp(dir=test_temp_dir)
+    dst_dir = tempfile.mkdtemp(dir=test_temp_dir)
+
+    with locks.repository_locks({src_dir: False, dst_dir: True}):
+        with locks.repository_locks({src_dir: False, dst_dir: True}):
+            assert not _can_lock(dst_dir, exclusive=False)
+        assert not _can_lock(dst_dir, exclusive=False)
+        assert _can_lock(src_dir, exclusive=False)
+
+    assert _can_lock(src_dir, exclusive=True)
+    assert _can_lock(dst_dir, exclusive=True)
+
+
+@coalescing_context
+def test_transplant_coalesced_with_failing_job(app):
+    nodes = _commit_src_files(app, 3)
+
+    # the second job conflicts with a change made in the destination meanwhile
+    with open(os.path.join(app.dst_dir, 'file1.txt'), 'w') as f:
+        f.write('conflict\n')
+    app.dst.commit('conflicting change', addremove=True, user='Test User')
+
+    results = {}
+
+    def run(node):
+        with app.app_context():
+            try:
+                results[node] = actions.transplant('test-src', 'test-dst', [{'commit': node}])
+            except actions.TransplantError, e:
+                results[node] = e
+
+    threads = [threading.Thread(target=run, args=(node,)) for node in nodes]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert isinstance(results[nodes[1]], actions.TransplantError)
+    assert 'tip' in results[nodes[0]]
+    assert 'tip' in results[nodes[2]]
+
+    messages = [commit_info.message for commit_info in app.dst.log(rev='all()')]
+    eq_(sorted(messages[2:]), ['add file 0', 'add file 2'])
+
+
+def test_single_flight_shares_exception():
+    flight = SingleFlight()
+    started = threading.Event()
+    finish = threading.Event()
+    calls = []
+
+    def lookup():
+        calls.append(None)
+        started.set()
+        finish.wait()
+        raise RuntimeError('lookup failed')
+
+    errors = []
+
+    def call():
+        try:
+            flight.do('tip', lookup)
+        except RuntimeError, e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=call) for _ in range(4)]
+    threads[0].start()
+    started.wait()
+    for thread in threads[1:]:
+        thread.start()
+
+    # let the other callers join the call in flight
+    time.sleep(0.5)
+    finish.set()
+    for thread in threads:
+        thread.join()
+
+    eq_(len(calls), 1)
+    eq_(len(errors), 4)
+    assert all(e is errors[0] for e in errors)
+
+    # a failed call isn't remembered
+    eq_(flight.do('tip', lambda: 'node'), 'node')
+
+
+def test_spool_pending_skips_forgotten_jobs():
+    spool = JobSpool(tempfile.mkdtemp(dir=test_temp_dir))
+    job_id = spool.add({'src': 'test-src', 'items': []})
+    names = os.listdir(spool.path)
+
+    spool.set_result(job_id, {'tip': '0123456789ab'})
+    spool.prune(max_age=-1)
+
+    # the job is forgotten between listing the spool and reading the job
+    with mock.patch.object(os, 'listdir', return_value=names):
+        eq_(spool.pending(), [])
+
+
+def test_spool_shares_identical_jobs():
+    spool = JobSpool(tempfile.mkdtemp(dir=test_temp_dir))
+    job = {'src': 'test-src', 'items': [{'commit': '0123456789ab'}]}
+
+    job_id = spool.add(job, key='job')
+    eq_(spool.add(job, key='job'), job_id)
+    eq_(len(spool.pending()), 1)
+    assert spool.add(job) != job_id
+
+    spool.set_result(job_id, {'tip': '0123456789ab'})
+    eq_(spool.add(job, key='job'), job_id)
+
+    # a failed job is tried again
+    failed_id = spool.add(job, key='failed')
+    spool.set_result(failed_id, {'error': 'conflict'})
+    assert spool.add(job, key='failed') != failed_id
+
+
+@coalescing_context
+def test_transplant_coalesced_job_of_killed_task(app):
+    node = _commit_src_files(app, 1)[0]
+    items = [{'commit': node}]
+
+    # left in the spool by a task killed before it got to apply its job
+    with app.app_context():
+        fingerprint = actions.get_job_fingerprint('test-src', 'test-dst', items)
+        actions.get_spool('test-dst').add({'src': 'test-src', 'items': items}, key=fingerprint)
+
+    with app.app_context():
+        result = actions.transplant('test-src', 'test-dst', items)
+
+    eq_(result, {'tip': app.dst.log(rev='tip')[0].node[:12]})
+    messages = [commit_info.message for commit_info in app.dst.log(rev='all()')]
+    eq_(messages, ['Initial commit', 'add file 0'])
+
+
+@revset_context
+def test_revset_info_immutable_revset(app, client):
+    _commit_src_files(app, 1)
+    node = app.src.log(rev='tip')[0].node
+    path = '/transplant/repositories/test-src/revsets/{}'.format(node)
+
+    rv = client.get(path)
+    eq_(rv.status_code, 200)
+    eq_(rv.headers['Cache-Control'], 'public, max-age=31536000')
+    eq_(json.loads(rv.data)['result']['commits'][0]['node'], node)
+    etag = rv.headers['ETag']
+
+    rv = client.get(path, headers={'If-None-Match': etag})
+    eq_(rv.status_code, 304)
+
+    # served from the commit info cache, without running hg
+    with mock.patch.object(actions, 'limited_log', side_effect=AssertionError('hg used')):
+        rv = client.get(path)
+    eq_(rv.status_code, 200)
+    eq_(rv.headers['ETag'], etag)
+    eq_(json.loads(rv.data)['result']['commits'][0]['node'], node)
+
+
+@revset_context
+def test_revset_info_mutable_revset(app, client):
+    rv = client.get('/transplant/repositories/test-src/revsets/tip')
+    eq_(rv.status_code, 200)
+    assert 'ETag' not in rv.headers
+    assert 'Cache-Control' not in rv.headers
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    eq_(cache.get('a'), 1)
+
+    cache.put('c', 3)
+    eq_(cache.get('b'), None)
+    eq_(cache.get('a'), 1)
+    eq_(cache.get('c'), 3)
+    eq_(len(cache), 2)
+
+
+def test_get_node_symbols():
+    eq_(actions.get_node_symbols('ABCDEF12'), set(['abcdef12']))
+    eq_(actions.get_node_symbols('ancestors(abcdef) and not keyword(fedcba)'), set(['abcdef']))
+    eq_(actions.get_node_symbols('only(abcdef, 123456) - desc("fedcba")'),
+        set(['abcdef', '123456']))
+    eq_(actions.get_node_symbols("tip + v1.abcdef + 'abcdef'"), set())
+
+
+@test_context
+def test_prepare_pulls_only_missing_nodes(app):
+    with app.app_context():
+        src_repo = actions.clone('test-src')
+    src_repo.local_command(['bookmark', 'abcdef'])
+    node = _commit_src_files(app, 1)[0]
+
+    pulls = []
+    pull_revisions = actions.pull_revisions
+
+    def record_pull(repository, revs):
+        pulls.append(sorted(revs))
+        return pull_revisions(repository, revs)
+
+    items = [{'revset': '{} + keyword(deadbeef)'.format(node)},
+             {'revset': 'abcdef + desc("cafebabe")'},
+             {'commit': 'fedcba98'}]
+    with app.app_context(), mock.patch.object(actions, 'pull_revisions', record_pull):
+        actions.prepare(src_repo, items)
+
+    # the bookmark resolves locally, the unknown revision isn't pulled again
+    eq_(pulls, [sorted([node, 'fedcba98']), [node]])
+    eq_(src_repo.log(rev=node)[0].node[:12], node)
+
+
+@test_context
+def test_command_server_runs_local_commands(app):
+    Repository.enable_command_server()
+    try:
+        with mock.patch.object(Repository, 'command', side_effect=AssertionError('spawned')):
+            eq_(app.src.log(rev='tip')[0].message, 'Initial commit')
+            assert_raises(MercurialException, app.src.local_command, ['cat', 'missing.txt'])
+            eq_(app.src.log(rev='tip')[0].message, 'Initial commit')
+
+        # a custom environment still needs a process of its own
+        with mock.patch.object(Repository, 'command', return_value='') as command:
+            app.src.local_command(['status'], env={'HGPLAIN': '1'})
+        eq_(command.call_count, 1)
+    finally:
+        Repository.disable_command_server()
+
+
+@test_context
+def test_command_server_pool_reuses_servers_of_own_process(app):
+    pool = CommandServerPool(Repository.cmd)
+    try:
+        server = pool.acquire(app.src_dir)
+        pool.release(server)
+        server = pool.acquire(app.src_dir)
+        pool.release(server)
+        assert pool.acquire(app.src_dir) is server
+        pool.release(server)
+
+        # servers of the parent share pipes with it after a fork
+        with mock.patch.object(os, 'getpid', return_value=os.getpid() + 1):
+            forked_server = pool.acquire(app.src_dir)
+        assert forked_server is not server
+        forked_server.close()
+        server.close()
+    finally:
+        pool.close()
+
+
+def test_split_fields():
+    chunks = ['node1\0da', 'te1\0', 'node2\0date2\0', 'node3']
+    eq_(list(repository.split_fields(chunks, 2)), [['node1', 'date1'], ['node2', 'date2']])
+
+
+@test_context
+def test_log_parses_messages_and_authors(app):
+    _set_test_file_content(app.src_dir, "Hello again!\n")
+    message = u'Second commit\n\nwith a body and {braces}'
+    app.src.commit(message.encode('utf-8'), user='Test User <test@example.com>')
+
+    commits = app.src.log(rev='all()')
+    eq_([commit.message for commit in commits], [u'Initial commit', message])
+    eq_([commit.author for commit in commits], [u'Test User', u'Test User <test@example.com>'])
+    eq_(len(commits[1].node), 40)
+
+    # iterating stops reading early
+    eq_(next(app.src.iter_log(rev='reverse(all())')).message, message)
+
+
+def _commit_fields(commits):
+    return [(commit.node, commit.date, commit.author, commit.message) for commit in commits]
+
+
+@test_context
+def test_commit_index(app):
+    index = CommitIndex(os.path.join(tempfile.mkdtemp(dir=test_temp_dir), 'commits.db'))
+    app.src.local_command(['phase', '--public', 'tip'])
+    eq_(index.update(app.src), 1)
+
+    initial = app.src.log(rev='tip')[0]
+    eq_(_commit_fields(index.lookup([initial.node])), _commit_fields([initial]))
+    eq_(_commit_fields(index.lookup([initial.node[:12]])), _commit_fields([initial]))
+    eq_(index.lookup(['0123456789ab']), None)
+
+    # drafts can be stripped, so they aren't indexed until they are published
+    _commit_src_files(app, 2)
+    eq_(index.update(app.src), 0)
+    app.src.local_command(['phase', '--public', 'tip'])
+    eq_(index.update(app.src), 2)
+
+    commits = app.src.log(rev='all()')
+    eq_(_commit_fields(index.lookup([commit.node for commit in commits])),
+        _commit_fields(commits))
+
+
+@commit_index_context
+def test_lookup_commit_index(app):
+    nodes = _commit_src_files(app, 2)
+    with app.app_context():
+        # changesets pulled from the (publishing) source are indexed by clone()
+        repository = actions.clone('test-src')
+        commits = actions.lookup_commit_index(repository, ' + '.join(reversed(nodes)))
+        eq_(actions.lookup_commit_index(repository, 'tip'), None)
+
+    expected = app.src.log(rev=list(reversed(nodes)))
+    eq_(_commit_fields(commits), _commit_fields(expected))
+
+
+@sync_context
+def test_sync_repositories(app):
+    app.config['TRANSPLANT_REPOSITORIES'][1]['sync_interval'] = 0
+    with app.app_context():
+        actions.clone('test-src')
+        nodes = _commit_src_files(app, 1)
+
+        with open(actions.get_sync_stamp_path('test-src'), 'w') as f:
+            f.write(repr(time.time() - 120))
+        actions.sync_repositories()
+        eq_(actions.clone('test-src').log(rev=nodes[0])[0].message, 'add file 0')
+        assert not os.path.exists(actions.get_sync_stamp_path('test-dst'))
+
+        # synced just now
+        with mock.patch.object(actions, 'sync', side_effect=AssertionError('synced')):
+            actions.sync_repositories()
+
+
+@sync_context
+def test_transplant_to_synced_destination_rebases_on_upstream(app):
+    nodes = _commit_src_files(app, 2)
+    with app.app_context():
+        actions.transplant('test-src', 'test-dst', [{'commit': nodes[0]}])
+
+    # pushed by someone else since the destination was synced
+    app.dst.update(rev='tip')
+    with open(os.path.join(app.dst_dir, 'upstream.txt'), 'w') as f:
+        f.write('upstream\n')
+    app.dst.commit('Upstream change', addremove=True, user='Test User')
+
+    rebase_on_upstream = mock.Mock(wraps=actions.rebase_on_upstream)
+    with app.app_context(), mock.patch.object(actions, 'rebase_on_upstream', rebase_on_upstream):
+        actions.transplant('test-src', 'test-dst', [{'commit': nodes[1]}])
+
+    # the destination wasn't pulled before transplanting, only after the push failed
+    eq_(rebase_on_upstream.call_count, 1)
+    messages = [commit_info.message for commit_info in app.dst.log(rev='::tip')]
+    eq_(messages, ['Initial commit', 'add file 0', 'Upstream change', 'add file 1'])
+
+
+@warm_up_context
+def test_warm_up_on_worker_init(app):
+    with app.app_context():
+        tasks.warm_up_on_worker_init(sender=mock.Mock(app=app.celery))
+        for name in ('test-src', 'test-dst'):
+            assert actions.is_cloned(actions.get_repo_dir(name))
+
+
+@test_context
+def test_warm_up_reports_failures(app):
+    app.config['TRANSPLANT_REPOSITORIES'].append({
+        'name': 'test-missing',
+        'path': os.path.join(test_temp_dir, 'missing')
+    })
+
+    progress = []
+    with app.app_context():
+        errors = actions.warm_up(concurrency=2, progress=lambda *args: progress.append(args))
+        assert actions.is_cloned(actions.get_repo_dir('test-src'))
+
+    eq_(errors.keys(), ['test-missing'])
+    eq_(sorted(done for name, done, total, error in progress), [1, 2, 3])
+    eq_(set(total for name, done, total, error in progress), set([3]))
+
+
+@test_context
+def test_cleanup_skipped_after_completed_job(app):
+    node = _commit_src_files(app, 1)[0]
+    with app.app_context(), mock.patch.object(Repository, 'purge') as purge:
+        actions.transplant('test-src', 'test-dst', [{'commit': node}])
+    eq_(purge.call_count, 0)
+
+
+@test_context
+def test_cleanup_after_failed_job(app):
+    _set_test_file_content(app.src_dir, "Hello Source!\n")
+    app.src.commit("Source change", user="Test User")
+    node = app.src.id(id=True)
+
+    app.dst.update(rev='tip')
+    _set_test_file_content(app.dst_dir, "Hello Destination!\n")
+    app.dst.commit("Destination change", user="Test User")
+
+    with app.app_context():
+        assert_raises(MercurialException, actions.transplant,
+                      'test-src', 'test-dst', [{'commit': node}])
+        dst_repo = actions.clone('test-dst')
+
+    # conflicting changes are reverted, and files left behind by the patch are purged
+    eq_(dst_repo.local_command(['status']), '')
+    eq_(_get_test_file_content(dst_repo.path), "Hello Destination!\n")
+    assert not dst_repo.is_transplanting()
+
+
+def test_get_purge_patterns():
+    eq_(actions.get_purge_patterns(set(['a.txt', 'b[1].txt'])),
+        ['path:a.txt', 'glob:a.txt.*', 'path:b[1].txt', 'glob:b\\[1\\].txt.*'])
+    eq_(actions.get_purge_patterns(set()), None)
+    eq_(actions.get_purge_patterns(None), None)
+
+
+def _transplant_with_message(app):
+    node = _commit_src_files(app, 1)[0]
+    message = u'Overridden message \u2014 r=reviewer\n\nwith a body'
+
+    with app.app_context():
+        actions.transplant('test-src', 'test-dst', [{'commit': node, 'message': message}])
+
+    commit_info = app.dst.log(rev='tip')[0]
+    eq_(commit_info.message, message)
+    eq_(commit_info.author, 'Test User')
+
+
+@test_context
+def test_transplant_overrides_message(app):
+    _transplant_with_message(app)
+
+
+@test_context
+def test_transplant_overrides_message_on_command_server(app):
+    Repository.enable_command_server()
+    try:
+        _transplant_with_message(app)
+    finally:
+        Repository.disable_command_server()
+
+
+@diff_squash_context
+def test_transplant_squashes_linear_revset_at_once(app):
+    nodes = _commit_src_files(app, 3)
+    items = [{'revset': '{}::{}'.format(nodes[0], nodes[-1]), 'message': 'squashed'}]
+
+    with app.app_context():
+        with mock.patch.object(Repository, 'collapse', side_effect=AssertionError('collapsed')):
+            actions.transplant('test-src', 'test-dst', items)
+
+    messages = [commit_info.message for commit_info in app.dst.log(rev='all()')]
+    eq_(messages, ['Initial commit', 'squashed'])
+    eq_(sorted(app.dst.files('tip')), ['file0.txt', 'file1.txt', 'file2.txt'])
+
+
+@diff_squash_context
+def test_transplant_squash_keeps_messages_by_default(app):
+    nodes = _commit_src_files(app, 2)
+    items = [{'revset': '{} + {}'.format(nodes[0], nodes[1])}]
+
+    with app.app_context():
+        actions.transplant('test-src', 'test-dst', items)
+
+    eq_(app.dst.log(rev='tip')[0].message, 'add file 0\n----------------\nadd file 1')
+
+
+@diff_squash_context
+def test_transplant_squash_of_nonlinear_revset_collapses(app):
+    nodes = _commit_src_files(app, 3)
+    items = [{'revset': '{} + {}'.format(nodes[0], nodes[2]), 'message': 'squashed'}]
+
+    with app.app_context(), mock.patch.object(Repository, 'collapse', autospec=True,
+                                              side_effect=Repository.collapse) as collapse:
+        actions.transplant('test-src', 'test-dst', items)
+
+    eq_(collapse.call_count, 1)
+    messages = [commit_info.message for commit_info in app.dst.log(rev='all()')]
+    eq_(messages, ['Initial commit', 'squashed'])
+    eq_(sorted(app.dst.files('tip')), ['file0.txt', 'file2.txt'])
+
+
+@patch_context
+def test_transplant_transfers_patches(app):
+    nodes = _commit_src_files(app, 3)
+    items = [{'commit': nodes[0], 'message': 'overridden'},
+             {'revset': '{}::{}'.format(nodes[1], nodes[2]), 'message': 'squashed'}]
+
+    transplant = mock.Mock(side_effect=AssertionError('hg transplant'))
+    with app.app_context(), mock.patch.object(Repository, 'transplant', transplant):
+        actions.transplant('test-src', 'test-dst', items)
+
+    commits = app.dst.log(rev='all()')
+    eq_([commit.message for commit in commits], ['Initial commit', 'overridden', 'squashed'])
+    eq_(commits[1].author, 'Test User')
+    eq_(sorted(app.dst.files('tip')), ['file1.txt', 'file2.txt'])
+
+
+@test_context
+def test_patch_cache(app):
+    _commit_src_files(app, 2)
+    nodes = [commit.node for commit in app.src.log(rev='all()')]
+    cache = PatchCache(os.path.join(tempfile.mkdtemp(dir=test_temp_dir), 'patches'), 2)
+
+    paths = cache.get(app.src, nodes[:2])
+    eq_([os.path.basename(path) for path in paths], [node + '.patch' for node in nodes[:2]])
+    with open(paths[1]) as f:
+        assert 'add file 0' in f.read()
+
+    # exported patches are reused, the least recently used ones are pruned
+    with mock.patch.object(Repository, 'export', side_effect=AssertionError('exported')):
+        cache.get(app.src, nodes[1:2])
+    time.sleep(0.01)
+    cache.get(app.src, nodes[2:])
+    eq_(sorted(os.listdir(cache.path)), sorted(node + '.patch' for node in nodes[1:]))
+
+
+def test_rewrite_patch_message():
+    patch = ('# HG changeset patch\n'
+             '# User Test User\n'
+             'original message\n'
+             '#kept line\n'
+             '\n'
+             'diff --git a/test.txt b/test.txt\n')
+    eq_(actions.rewrite_patch_message(patch, u'new message\n'),
+        '# HG changeset patch\n'
+        '# User Test User\n'
+        '#kept line\n'
+        'new message\n'
+        '\n'
+        'diff --git a/test.txt b/test.txt\n')
+
+
+@contextlib.contextmanager
+def _worker(app, queues=('transplant',)):
+    """Run a worker consuming `queues` in a thread."""
+
+    worker = app.celery.WorkController(pool_cls='solo', queues=list(queues), concurrency=1)
+
+    def run():
+        # chained tasks are sent by the current celery app
+        app.celery.set_current()
+        with app.app_context():
+            worker.start()
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield worker
+    finally:
+        worker.stop()
+        thread.join(10)
+
+
+def _wait_until_ready(client, path, attempts=60, interval=0.5):
+    for _ in range(attempts):
+        rv = client.get(path)
+        eq_(rv.status_code, 200)
+
+        result = json.loads(rv.data)['result']
+        if result['state'] not in ('PENDING', 'STARTED', 'PROGRESS'):
+            return result
+
+        time.sleep(interval)
+
+    raise RuntimeError('{} is not ready after {} attempts'.format(path, attempts))
+
+
+def _add_dst_repository(app, name):
+    repo_dir = tempfile.mkdtemp(dir=test_temp_dir)
+    repository = Repository.init(repo_dir)
+    repository.pull(app.src_dir, update=True)
+    app.config['TRANSPLANT_REPOSITORIES'].append({'name': name, 'path': repo_dir})
+    return repository
+
+
+@worker_context
+def test_transplant_batch(app, client):
+    dst2 = _add_dst_repository(app, 'test-dst2')
+    nodes = _commit_src_files(app, 3)
+
+    rv = client.post_json('/transplant/batch', {'tasks': [
+        {'src': 'test-src', 'dst': 'test-dst', 'items': [{'commit': nodes[0]}]},
+        {'src': 'test-src', 'dst': 'test-dst2', 'items': [{'commit': '0123456789ab'}]},
+        {'src': 'test-src', 'dst': 'test-dst', 'items': [{'commit': nodes[1]}]},
+        {'src': 'test-src', 'dst': 'test-dst2', 'items': [{'commit': nodes[2]}]},
+    ]})
+    eq_(rv.status_code, 202)
+    batch = json.loads(rv.data)['result']
+    eq_(len(batch['tasks']), 4)
+
+    with _worker(app):
+        result = _wait_until_ready(client, '/transplant/batch/{}'.format(batch['batch']))
+
+    # a failed job cancels the later ones to the same destination only
+    eq_(result['state'], 'FAILURE')
+    eq_([r['state'] for r in result['results']], ['SUCCESS', 'FAILURE', 'SUCCESS', 'SKIPPED'])
+    messages = [commit_info.message for commit_info in app.dst.log(rev='all()')]
+    eq_(messages, ['Initial commit', 'add file 0', 'add file 1'])
+    eq_(len(dst2.log(rev='all()')), 1)
+
+
+@worker_context
+def test_transplant_batch_rejects_invalid_tasks(app, client):
+    rv = client.post_json('/transplant/batch', {'tasks': [
+        {'src': 'unknown', 'dst': 'test-dst', 'items': []},
+        {'src': 'test-src', 'dsts': ['test-dst'], 'items': []},
+    ]})
+    eq_(rv.status_code, 400)
+
+    rv = client.get('/transplant/batch/unknown')
+    eq_(rv.status_code, 404)
+
+
+@worker_context
+def test_transplant_fan_out(app, client):
+    dst2 = _add_dst_repository(app, 'test-dst2')
+    with open(os.path.join(dst2.path, 'file0.txt'), 'w') as f:
+        f.write('conflict\n')
+    dst2.commit('Conflicting change', addremove=True, user='Test User')
+    nodes = _commit_src_files(app, 1)
+
+    rv = client.post_json('/transplant/transplant', {
+        'src': 'test-src',
+        'dsts': ['test-dst', 'test-dst2', 'test-dst'],
+        'items': [{'commit': nodes[0]}]
+    })
+    eq_(rv.status_code, 202)
+    task_id = json.loads(rv.data)['result']['task']
+
+    with _worker(app):
+        result = _wait_until_ready(client, '/transplant/result/{}'.format(task_id))
+
+    # a failed destination doesn't fail the others
+    eq_(result['state'], 'SUCCESS')
+    eq_(result['tips'], {'test-dst': app.dst.log(rev='tip')[0].node[:12]})
+    eq_(result['errors'].keys(), ['test-dst2'])
+    eq_(app.dst.log(rev='tip')[0].message, 'add file 0')
+
+
+@worker_context
+def test_transplant_fan_out_rejects_dst_and_dsts(app, client):
+    rv = client.post_json('/transplant/transplant', {
+        'src': 'test-src',
+        'dst': 'test-dst',
+        'dsts': ['test-dst'],
+        'items': []
+    })
+    eq_(rv.status_code, 400)
+
+
+@test_context
+def test_pin_items(app):
+    nodes = _commit_src_files(app, 2)
+    items = [{'revset': '{}::{}'.format(nodes[0], nodes[1]), 'message': 'squashed'},
+             {'commit': nodes[1][:8]}]
+
+    with app.app_context():
+        pinned = actions.pin_items('test-src', items)
+
+    full_nodes = [commit.node for commit in app.src.log(rev=nodes)]
+    eq_(pinned, [{'revset': ' + '.join(full_nodes), 'message': 'squashed'},
+                 {'commit': full_nodes[1]}])
+
+
+def test_metrics_of_processes_add_up():
+    path = tempfile.mkdtemp(dir=test_temp_dir)
+    for value in (0.2, 3):
+        # every process saves its own metrics
+        metrics = Metrics(path, buckets=(1, 5))
+        metrics.observe('duration_seconds', {'stage': 'push'}, value)
+        metrics.inc('output_bytes_total', {'repository': 'a "b"'}, 10)
+        metrics.flush()
+
+    eq_(actions.render_metrics(actions.collect_metrics(path)).splitlines(), [
+        '# TYPE duration_seconds histogram',
+        'duration_seconds_bucket{stage="push",le="1.0"} 1',
+        'duration_seconds_bucket{stage="push",le="5.0"} 2',
+        'duration_seconds_bucket{stage="push",le="+Inf"} 2',
+        'duration_seconds_sum{stage="push"} 3.2',
+        'duration_seconds_count{stage="push"} 2',
+        '# TYPE output_bytes_total counter',
+        'output_bytes_total{repository="a \\"b\\""} 20',
+    ])
+
+
+@metrics_context
+def test_metrics_endpoint(app, client):
+    node = _commit_src_files(app, 1)[0]
+    with mock.patch.object(actions, '_metrics', None):
+        with app.app_context():
+            actions.transplant('test-src', 'test-dst', [{'commit': node}])
+
+        rv = client.get('/transplant/metrics')
+
+    eq_(rv.status_code, 200)
+    assert rv.content_type.startswith('text/plain')
+    lines = rv.data.splitlines()
+    assert 'transplant_stage_duration_seconds_count{outcome="ok",stage="push"} 1' in lines
+    assert any(line.startswith('transplant_hg_command_duration_seconds_count{command="push"')
+               for line in lines)
+
+
+@test_context.specialize(perms=[p.transplant.metrics])
+def test_metrics_endpoint_disabled(app, client):
+    rv = client.get('/transplant/metrics')
+    eq_(rv.status_code, 404)
+
+
+def test_progress_publisher():
+    task = mock.Mock()
+    publisher = tasks.ProgressPublisher(task, 'task-id')
+    publisher('prepared')
+    publisher('item_started', item=0)
+
+    meta = task.update_state.call_args[1]['meta']
+    eq_(meta['version'], 2)
+    eq_([event['event'] for event in meta['events']], ['prepared', 'item_started'])
+    eq_(meta['events'][1]['item'], 0)
+
+    # a failure to publish progress doesn't fail the job
+    task.update_state.side_effect = IOError('backend is down')
+    publisher('pulled')
+
+
+@revset_context
+def test_wait_result(app, client):
+    events = [{'event': 'prepared', 'time': '2015-01-01T00:00:00'},
+              {'event': 'pulled', 'time': '2015-01-01T00:00:01'}]
+    app.celery.backend.store_result('task-id', {'version': 2, 'events': events}, 'PROGRESS')
+
+    # returns at once, as there's progress the client hasn't seen
+    rv = client.get('/transplant/result/task-id/wait?version=1')
+    eq_(rv.status_code, 200)
+    result = json.loads(rv.data)['result']
+    eq_(result['state'], 'PROGRESS')
+    eq_(result['version'], 2)
+    eq_([event['event'] for event in result['events']], ['prepared', 'pulled'])
+
+    start = time.time()
+    rv = client.get('/transplant/result/task-id/wait?version=2&timeout=1')
+    assert time.time() - start >= 1
+    eq_(json.loads(rv.data)['result']['version'], 2)
+
+    app.celery.backend.store_result('task-id', {'tip': '0123456789ab'}, 'SUCCESS')
+    rv = client.get('/transplant/result/task-id/wait?version=2')
+    result = json.loads(rv.data)['result']
+    eq_(result['state'], 'SUCCESS')
+    eq_(result['tip'], '0123456789ab')
+
+
+@worker_context
+def test_transplant_publishes_progress(app, client):
+    node = _commit_src_files(app, 1)[0]
+    published = []
+    publish = tasks.ProgressPublisher.__call__
+
+    def record(self, event, **details):
+        published.append(event)
+        publish(self, event, **details)
+
+    rv = client.post_json('/transplant/transplant', {
+        'src': 'test-src',
+        'dst': 'test-dst',
+        'items': [{'commit': node}]
+    })
+    task_id = json.loads(rv.data)['result']['task']
+
+    with mock.patch.object(tasks.ProgressPublisher, '__call__', record), _worker(app):
+        version = 0
+        for _ in range(10):
+            rv = client.get('/transplant/result/{}/wait?version={}&timeout=30'.format(
+                task_id, version))
+            result = json.loads(rv.data)['result']
+            if result['state'] in ('SUCCESS', 'FAILURE'):
+                break
+
+            # every call returns a newer version, or times out
+            version = result.get('version') or 0
+
+    eq_(result['state'], 'SUCCESS')
+    eq_(result['tip'], app.dst.log(rev='tip')[0].node[:12])
+    eq_(published, ['prepared', 'pulled', 'item_started', 'item_transplanted', 'pushed'])
+
+
+def test_repository_generator_is_reproducible():
+    histories = []
+    for _ in range(2):
+        path = os.path.join(tempfile.mkdtemp(dir=test_temp_dir), 'repo')
+        generator = benchmark.RepositoryGenerator(files=5, file_size=200, seed=1)
+        repo = generator.generate(path, 20, heads=3)
+        eq_(len(repo.log(rev='all()')), 20)
+        eq_(len(repo.log(rev='heads(all())')), 3)
+
+        # the initial commit is dated now, so only messages and contents are the same
+        with open(os.path.join(path, 'dir1', 'file1.txt')) as f:
+            histories.append(([commit.message for commit in repo.log(rev='all()')], f.read()))
+
+    eq_(histories[0], histories[1])
+
+
+@test_context
+def test_benchmark(app):
+    repositories = list(app.config['TRANSPLANT_REPOSITORIES'])
+    progress = []
+    with app.app_context():
+        results = benchmark.run(commits=10, files=5, file_size=200, repeat=1,
+                                progress=lambda name, *args: progress.append(name))
+
+    eq_(results['results'].keys(), [
+        'clone', 'revset_info_range', 'revset_info_nodes', 'transplant_commit',
+        'transplant_revset_10', 'transplant_revset_100', 'push', 'cleanup'])
+    eq_(progress, results['results'].keys())
+    eq_(results['parameters']['commits'], 10)
+
+    # the generated repositories were configured for the benchmark only
+    eq_(app.config['TRANSPLANT_REPOSITORIES'], repositories)
+
+
+@test_context
+def test_transplant_traced(app):
+    node = _commit_src_files(app, 1)[0]
+    trace = Trace()
+    with app.app_context(), actions.tracing(trace):
+        actions.transplant('test-src', 'test-dst', [{'commit': node}])
+
+    events = trace.as_dict()['events']
+    eq_(events, sorted(events, key=lambda event: event['start']))
+
+    stages = [event['name'] for event in events if event['type'] == 'stage']
+    eq_(stages, ['prepare', 'pull', 'transplant', 'push', 'cleanup'])
+
+    commands = [event for event in events if event['type'] == 'command']
+    transplant = [event for event in commands if event['name'] == 'transplant'][0]
+    eq_(transplant['outcome'], 'ok')
+    assert node in transplant['args']
+    assert 'cpu_user' in transplant
+
+
+@worker_context
+def test_transplant_trace_endpoint(app, client):
+    node = _commit_src_files(app, 1)[0]
+    rv = client.post_json('/transplant/transplant', {
+        'src': 'test-src',
+        'dst': 'test-dst',
+        'items': [{'commit': node}]
+    })
+    task_id = json.loads(rv.data)['result']['task']
+
+    with _worker(app):
+        _wait_until_ready(client, '/transplant/result/{}'.format(task_id))
+
+    rv = client.get('/transplant/result/{}/trace'.format(task_id))
+    eq_(rv.status_code, 200)
+    trace = json.loads(rv.data)['result']
+    eq_(trace['task'], task_id)
+    assert 'push' in [event['name'] for event in trace['events'] if event['type'] == 'stage']
+
+    rv = client.get('/transplant/result/unknown/trace')
+    eq_(rv.status_code, 404)
+
+
+def _clone_from_seed(app):
+    nodes = _commit_src_files(app, 2)
+    clone = mock.Mock(wraps=Repository.clone)
+    with app.app_context(), mock.patch.object(Repository, 'clone', clone):
+        repository = actions.clone('test-src')
+
+    # only what the seed is missing is pulled from the source
+    eq_([commit.message for commit in repository.log(rev='all()')],
+        ['Initial commit', 'add file 0', 'add file 1'])
+    eq_(repository.id(id=True), nodes[-1])
+    eq_(repository.local_command(['paths', 'default']).strip(), app.src_dir)
+    return clone
+
+
+@test_context
+def test_clone_from_seed_dir(app):
+    seed_dir = tempfile.mkdtemp(dir=test_temp_dir)
+    Repository.clone(app.src_dir, os.path.join(seed_dir, 'test-src'))
+    app.config['TRANSPLANT_SEED_DIR'] = seed_dir
+
+    clone = _clone_from_seed(app)
+    eq_(clone.call_args[0][0], os.path.join(seed_dir, 'test-src'))
+
+
+@test_context
+def test_clone_from_seed_bundle(app):
+    bundle = os.path.join(tempfile.mkdtemp(dir=test_temp_dir), 'test-src.hg')
+    app.src.local_command(['bundle', '--all', bundle])
+    app.config['TRANSPLANT_REPOSITORIES'][0]['seed'] = bundle
+
+    clone = _clone_from_seed(app)
+    eq_(clone.call_count, 0)
+
+
+@test_context
+def test_clone_from_broken_seed(app):
+    seed_dir = tempfile.mkdtemp(dir=test_temp_dir)
+    os.mkdir(os.path.join(seed_dir, 'test-src'))
+    app.config['TRANSPLANT_SEED_DIR'] = seed_dir
+
+    # cloned from the source instead
+    clone = _clone_from_seed(app)
+    eq_(clone.call_args[0][0], app.src_dir)
+
+
+@stream_clone_context
+def test_stream_clone(app):
+    clone = mock.Mock(wraps=Repository.clone)
+    with app.app_context(), mock.patch.object(Repository, 'clone', clone):
+        repository = actions.clone('test-src')
+
+    eq_(clone.call_args[1]['uncompressed'], True)
+    eq_(repository.log(rev='tip')[0].message, 'Initial commit')
+
+
+@async_lookups_context
+def test_revset_info_async_lookup(app, client):
+    _commit_src_files(app, 1)
+    node = app.src.log(rev='tip')[0].node
+    path = '/transplant/repositories/test-src/revsets/{}'.format(node)
+
+    rv = client.get(path)
+    eq_(rv.status_code, 202)
+    eq_(rv.headers['Cache-Control'], 'no-cache')
+    lookup = json.loads(rv.data)['result']
+    eq_(lookup['state'], 'QUEUED')
+
+    # identical requests share the lookup
+    rv = client.get(path)
+    eq_(json.loads(rv.data)['result']['task'], lookup['task'])
+
+    with _worker(app, queues=['lookup']):
+        for _ in range(60):
+            rv = client.get('{}?task={}'.format(path, lookup['task']))
+            if rv.status_code != 202:
+                break
+            time.sleep(0.5)
+
+    eq_(rv.status_code, 200)
+    eq_(json.loads(rv.data)['result']['commits'][0]['node'], node)
+
+    # answered from the cache from now on
+    rv = client.get(path)
+    eq_(rv.status_code, 200)
+
+
+@async_lookups_context
+def test_revset_info_async_lookup_of_unknown_repository(app, client):
+    rv = client.get('/transplant/repositories/unknown/revsets/tip')
+    eq_(rv.status_code, 400)
@@ -0,0 +1,80 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import errno
+import logging
+import os
+import shutil
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+
+class PatchCache(object):
+
+    """Changesets exported with `hg export --git`, one file per node.
+
+    Nodes identify changesets across repositories, so the cache is shared by all of them.
+    """
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+
+    def get(self, repository, nodes):
+        """Get patch files of nodes, exporting the missing ones from repository at once."""
+
+        if not os.path.exists(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+        missing = [node for node in nodes if not os.path.exists(self._get_path(node))]
+        if missing:
+            logger.info('exporting %d changesets from "%s"', len(missing), repository.path)
+            self._export(repository, missing)
+            self._prune()
+
+        paths = [self._get_path(node) for node in nodes]
+        for path in paths:
+            # recently used patches are pruned last
+            os.utime(path, None)
+
+        return paths
+
+    def _get_path(self, node):
+        return os.path.join(self.path, node + '.patch')
+
+    def _export(self, repository, nodes):
+        tmpdir = tempfile.mkdtemp(dir=self.path)
+        try:
+            repository.export(nodes, os.path.join(tmpdir, '%H.patch'), git=True)
+
+            # other processes may export the same nodes, but the content is the same
+            for node in nodes:
+                os.rename(os.path.join(tmpdir, node + '.patch'), self._get_path(node))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def _prune(self):
+        entries = []
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            if not name.endswith('.patch'):
+                continue
+
+            try:
+                entries.append((os.path.getmtime(path), path))
+            except OSError:
+                # pruned by another process
+                pass
+
+        entries.sort()
+        for _, path in entries[:max(len(entries) - self.max_size, 0)]:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
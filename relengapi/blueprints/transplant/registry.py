@@ -0,0 +1,42 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import copy
+import threading
+
+
+class RepositoryRegistry(object):
+
+    """Repositories that have already been cloned and configured, keyed by path."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def get(self, path, config):
+        """Get a prepared repository, or None if it has to be (re)configured."""
+
+        with self.lock:
+            entry = self.entries.get(path)
+
+        if entry is None:
+            return None
+
+        repository, configured = entry
+        if configured != config:
+            return None
+
+        return repository
+
+    def add(self, repository, config):
+        with self.lock:
+            self.entries[repository.path] = (repository, copy.deepcopy(config))
+
+    def discard(self, path):
+        with self.lock:
+            self.entries.pop(path, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries = {}
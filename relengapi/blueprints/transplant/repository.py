@@ -2,13 +2,22 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import errno
+import logging
 import os
 import pipes
 import subprocess
-import xml.etree.ElementTree as ET
+import tempfile
+import time
+
+from commandserver import CommandServerError
+from commandserver import CommandServerPool
 
 import rest
 
+logger = logging.getLogger(__name__)
+
+
 def mkdirp(fullpath):
     if not os.path.exists(fullpath):
         os.makedirs(fullpath)
@@ -17,20 +26,89 @@ def mkdirp(fullpath):
 class Repository(object):
     cmd = "hg"
     registered_extensions = {}
+    builtin_extensions = ['purge', 'rebase', 'share', 'strip', 'transplant']
+    command_server_pool = None
+    command_observer = None
+
+    # global options taking a value, see get_subcommand()
+    value_options = ['--config', '--encoding', '--repository', '-R', '--cwd']
+
+    # null-terminated fields, see iter_log()
+    log_template = r'{node}\0{date|rfc3339date}\0{author|person}\0{author|email}\0{desc}\0'
+    log_fields = 5
+    files_template = r'{files % "{file}\0"}'
+    stream_chunk_size = 64 * 1024
 
     def __init__(self, path):
         self.path = path
 
     @staticmethod
     def unsafe_command(cmd, **kwargs):
-        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, **kwargs)
+        p = RusagePopen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, **kwargs)
         stdout, stderr = p.communicate()
-        return p.returncode, stdout, stderr
+        return p.returncode, stdout, stderr, p.rusage
+
+    @classmethod
+    def set_command_observer(cls, observer):
+        """Call `observer` after every hg command.
+
+        It gets the subcommand, the repository path (or None), the outcome
+        (``ok``, ``error`` for non-zero exit codes, or ``failed`` if hg couldn't be run),
+        the duration in seconds and the size of the output in bytes. Keyword arguments
+        are the full argument list (``args``), the size of stderr (``error_size``)
+        and the resource usage of the hg process (``rusage``, None for commands
+        run by a command server).
+        """
+
+        # a plain function would become an unbound method
+        cls.command_observer = staticmethod(observer) if observer is not None else None
+
+    @classmethod
+    def observe_command(cls, args, path, outcome, start, output_size=0, error_size=0,
+                        rusage=None):
+        if cls.command_observer is None:
+            return
+
+        try:
+            cls.command_observer(cls.get_subcommand(args), path, outcome,
+                                 time.time() - start, output_size,
+                                 args=args, error_size=error_size, rusage=rusage)
+        except Exception:
+            logger.exception('command observer failed')
+
+    @classmethod
+    def get_subcommand(cls, args):
+        args = iter(args)
+        for arg in args:
+            if arg in cls.value_options:
+                next(args, None)
+            elif not arg.startswith('-'):
+                return arg
+
+        return None
 
     @classmethod
     def register_extension(cls, name, path):
         cls.registered_extensions[name] = path
 
+    @classmethod
+    def enable_command_server(cls, max_idle=2):
+        if cls.command_server_pool is not None:
+            return
+
+        # extensions can't be enabled per command, so load all of them upfront
+        extensions = set(cls.builtin_extensions) | set(cls.registered_extensions)
+        config = cls._get_extensions_config(sorted(extensions))
+        cls.command_server_pool = CommandServerPool(cls.cmd, config=config, max_idle=max_idle)
+
+    @classmethod
+    def disable_command_server(cls):
+        if cls.command_server_pool is None:
+            return
+
+        cls.command_server_pool.close()
+        cls.command_server_pool = None
+
     @classmethod
     def command(cls, args, extensions=None, **kwargs):
         cmd = [cls.cmd]
@@ -39,12 +117,60 @@ class Repository(object):
         cmd.extend(extensions_config)
         cmd.extend(args)
 
-        returncode, stdout, stderr = cls.unsafe_command(cmd, **kwargs)
+        start = time.time()
+        try:
+            returncode, stdout, stderr, rusage = cls.unsafe_command(cmd, **kwargs)
+        except OSError:
+            cls.observe_command(args, kwargs.get('cwd'), 'failed', start)
+            raise
+
+        outcome = 'ok' if returncode == 0 else 'error'
+        cls.observe_command(args, kwargs.get('cwd'), outcome, start,
+                            len(stdout), len(stderr), rusage)
         if returncode != 0:
             raise MercurialException(cmd, returncode, stdout, stderr)
 
         return stdout
 
+    @classmethod
+    def stream_command(cls, args, extensions=None, **kwargs):
+        """Same as command(), but yields stdout in chunks as soon as they're read."""
+
+        cmd = [cls.cmd]
+        cmd.extend(cls._get_extensions_config(extensions))
+        cmd.extend(args)
+
+        # stderr is only read when the command fails, so don't let it fill a pipe
+        stderr = tempfile.TemporaryFile()
+        start = time.time()
+        p = RusagePopen(cmd, stdout=subprocess.PIPE, stderr=stderr, **kwargs)
+        size = 0
+        try:
+            while True:
+                chunk = os.read(p.stdout.fileno(), cls.stream_chunk_size)
+                if not chunk:
+                    break
+
+                size += len(chunk)
+                yield chunk
+
+            p.wait()
+            outcome = 'ok' if p.returncode == 0 else 'error'
+            cls.observe_command(args, kwargs.get('cwd'), outcome, start,
+                                size, os.fstat(stderr.fileno()).st_size, p.rusage)
+            if p.returncode != 0:
+                stderr.seek(0)
+                raise MercurialException(cmd, p.returncode, '', stderr.read())
+
+        finally:
+            # the caller stopped reading early
+            if p.returncode is None:
+                p.kill()
+                p.wait()
+
+            p.stdout.close()
+            stderr.close()
+
     @classmethod
     def _get_extensions_config(cls, extensions):
         if extensions is None:
@@ -62,10 +188,17 @@ class Repository(object):
         return extensions_config
 
     @classmethod
-    def clone(cls, source, destination, rev=None):
+    def clone(cls, source, destination, rev=None, noupdate=False, uncompressed=False):
         mkdirp(destination)
         cmd = ['clone']
 
+        if noupdate:
+            cmd.append('--noupdate')
+
+        # streams raw store files, unless the server disallows it or revisions are given
+        if uncompressed:
+            cmd.append('--uncompressed')
+
         if rev:
             if not isinstance(rev, list):
                 rev = [rev]
@@ -78,6 +211,19 @@ class Repository(object):
         cls.command(cmd)
         return Repository(destination)
 
+    @classmethod
+    def share(cls, source, destination, noupdate=False):
+        mkdirp(os.path.dirname(destination))
+        cmd = ['share']
+
+        if noupdate:
+            cmd.append('--noupdate')
+
+        cmd.extend([source, destination])
+
+        cls.command(cmd, extensions=['share'])
+        return Repository(destination)
+
     @classmethod
     def init(cls, destination):
         mkdirp(destination)
@@ -85,8 +231,35 @@ class Repository(object):
         return Repository(destination)
 
     def local_command(self, args, **kwargs):
+        # custom environment can't be passed to a running command server
+        if self.command_server_pool is not None and 'env' not in kwargs:
+            try:
+                server = self.command_server_pool.acquire(self.path)
+            except CommandServerError, e:
+                logger.warning('%s, falling back to subprocess', e)
+            else:
+                return self.server_command(server, args)
+
         return self.command(args, cwd=self.path, **kwargs)
 
+    def server_command(self, server, args):
+        cmd = [self.cmd] + args
+        start = time.time()
+        try:
+            returncode, stdout, stderr = server.runcommand(args)
+        except CommandServerError, e:
+            server.close()
+            self.observe_command(args, self.path, 'failed', start)
+            raise MercurialException(cmd, -1, '', str(e))
+
+        self.command_server_pool.release(server)
+        outcome = 'ok' if returncode == 0 else 'error'
+        self.observe_command(args, self.path, outcome, start, len(stdout), len(stderr))
+        if returncode != 0:
+            raise MercurialException(cmd, returncode, stdout, stderr)
+
+        return stdout
+
     def id(self, **kwargs):
         cmd = ['id']
 
@@ -113,9 +286,32 @@ class Repository(object):
 
         self.local_command(cmd)
 
-    def push(self):
+    def bundle(self, path, base=None, rev=None, type=None):
+        cmd = ['bundle']
+
+        if base:
+            cmd.extend(['--base', base])
+
+        if rev:
+            cmd.extend(['--rev', rev])
+
+        if type:
+            cmd.extend(['--type', type])
+
+        cmd.append(path)
+        return self.local_command(cmd)
+
+    def unbundle(self, path):
+        return self.local_command(['unbundle', path])
+
+    def push(self, rev=None):
+        cmd = ['push']
+
+        if rev:
+            cmd.extend(['--rev', rev])
+
         try:
-            return self.local_command(['push'])
+            return self.local_command(cmd)
         except MercurialException, e:
             if e.returncode == 1:
                 return e.stdout
@@ -123,39 +319,84 @@ class Repository(object):
                 raise e
 
     def log(self, **kwargs):
-        output = self.raw_log(style='xml', **kwargs)
+        return list(self.iter_log(**kwargs))
 
-        if output == "":
-            return []
+    def iter_log(self, rev=None, limit=None):
+        """Yield CommitInfo objects while `hg log` output is being read.
+
+        Stop iterating early to stop reading, or use `limit` to make hg stop
+        on its own.
+        """
 
-        results = []
-        root = ET.fromstring(output)
-        for logentry in root.iter('logentry'):
-            node = logentry.get('node')
-            date = logentry.find('date').text
-            message = logentry.find('msg').text
-            xmlAuthor = logentry.find('author')
-            author_name = xmlAuthor.text
-            author_email = xmlAuthor.get('email')
-
-            # I hate Mercurial
-            if author_name == author_email:
-                author = author_name
+        cmd = ['--encoding', 'utf-8', 'log', '--template', self.log_template]
+
+        if rev:
+            if not isinstance(rev, list):
+                rev = [rev]
+
+            for r in rev:
+                cmd.extend(['--rev', r])
+
+        if limit:
+            cmd.extend(['--limit', str(limit)])
+
+        try:
+            # command server output can't be streamed
+            if self.command_server_pool is not None:
+                chunks = [self.local_command(cmd)]
             else:
-                author = author_name + ' <' + author_email + '>'
-
-            result = rest.CommitInfo(
-                node=node,
-                date=date,
-                author=author,
-                message=message
-            )
-            results.append(result)
-        return results
-
-    def raw_log(self, rev=None, style=None, **kwargs):
+                chunks = self.stream_command(cmd, cwd=self.path)
+
+            for fields in split_fields(chunks, self.log_fields):
+                yield self._commit_info(*fields)
+        except MercurialException, e:
+            if 'abort: unknown revision' in e.stderr:
+                raise UnknownRevisionException(rev, cause=e)
+            else:
+                raise e
+
+    @staticmethod
+    def _commit_info(node, date, author_name, author_email, message):
+        # I hate Mercurial
+        if author_name == author_email:
+            author = author_name
+        else:
+            author = author_name + ' <' + author_email + '>'
+
+        return rest.CommitInfo(
+            node=node.decode('ascii'),
+            date=date.decode('ascii'),
+            author=author.decode('utf-8', 'replace'),
+            message=message.decode('utf-8', 'replace')
+        )
+
+    def files(self, rev):
+        """Get the set of files changed by the revset."""
+
+        cmd = ['log', '--template', self.files_template]
+
+        if not isinstance(rev, list):
+            rev = [rev]
+
+        for r in rev:
+            cmd.extend(['--rev', r])
+
+        try:
+            output = self.local_command(cmd)
+        except MercurialException, e:
+            if 'abort: unknown revision' in e.stderr:
+                raise UnknownRevisionException(rev, cause=e)
+            else:
+                raise e
+
+        return set(path for path in output.split('\0') if path)
+
+    def raw_log(self, rev=None, style=None, template=None, encoding=None, **kwargs):
         cmd = ['log']
 
+        if encoding:
+            cmd = ['--encoding', encoding] + cmd
+
         if rev:
             if not isinstance(rev, list):
                 rev = [rev]
@@ -166,6 +407,9 @@ class Repository(object):
         if style:
             cmd.extend(['--style', style])
 
+        if template:
+            cmd.extend(['--template', template])
+
         try:
             return self.local_command(cmd, **kwargs)
         except MercurialException, e:
@@ -174,12 +418,27 @@ class Repository(object):
             else:
                 raise e
 
-    def transplant(self, revset, source=None, filter=None, **kwargs):
+    def transplant(self, revset, source=None, filter=None, message=None, **kwargs):
+        """Transplant revset, optionally overriding the message of every changeset.
+
+        Messages are overridden in-process by the registered transplantmessage extension.
+        """
+
         cmd = ['transplant']
+        extensions = ['transplant']
 
         if source:
             cmd.extend(['--source', source])
 
+        if message is not None:
+            if isinstance(message, unicode):
+                message = message.encode('utf-8')
+
+            cmd = ['--encoding', 'utf-8'] + cmd
+            cmd.extend(['--config', 'transplantmessage.message=' + message])
+            filter = 'transplantmessage'
+            extensions.append('transplantmessage')
+
         if filter:
             cmd.extend(['--filter', filter])
 
@@ -188,7 +447,57 @@ class Repository(object):
         else:
             cmd.append(revset)
 
-        return self.local_command(cmd, extensions=['transplant'], **kwargs)
+        return self.local_command(cmd, extensions=extensions, **kwargs)
+
+    def diff(self, rev, git=False):
+        cmd = ['diff']
+
+        if git:
+            cmd.append('--git')
+
+        if not isinstance(rev, list):
+            rev = [rev]
+
+        for r in rev:
+            cmd.extend(['--rev', r])
+
+        return self.local_command(cmd)
+
+    def export(self, rev, output, git=False):
+        cmd = ['--encoding', 'utf-8', 'export', '--output', output]
+
+        if git:
+            cmd.append('--git')
+
+        if not isinstance(rev, list):
+            rev = [rev]
+
+        for r in rev:
+            cmd.extend(['--rev', r])
+
+        return self.local_command(cmd)
+
+    def import_patch(self, path, message=None, user=None, date=None):
+        cmd = ['--encoding', 'utf-8', 'import']
+
+        if message is not None:
+            if isinstance(message, unicode):
+                message = message.encode('utf-8')
+
+            cmd.extend(['--message', message])
+
+        if user:
+            cmd.extend(['--user', user])
+
+        if date:
+            cmd.extend(['--date', date])
+
+        if isinstance(path, list):
+            cmd.extend(path)
+        else:
+            cmd.append(path)
+
+        return self.local_command(cmd)
 
     def commit(self, message, addremove=False, user=None):
         cmd = ['commit', '--message', message]
@@ -201,15 +510,18 @@ class Repository(object):
 
         return self.local_command(cmd)
 
-    def update(self, clean=False):
+    def update(self, clean=False, rev=None):
         cmd = ['update']
 
         if clean:
             cmd.append('--clean')
 
+        if rev:
+            cmd.extend(['--rev', rev])
+
         return self.local_command(cmd)
 
-    def purge(self, abort_on_err=False, all=False):
+    def purge(self, abort_on_err=False, all=False, patterns=None):
         cmd = ['purge']
 
         if abort_on_err:
@@ -218,6 +530,9 @@ class Repository(object):
         if all:
             cmd.append('--all')
 
+        if patterns:
+            cmd.extend(patterns)
+
         return self.local_command(cmd, extensions=['purge'])
 
     def strip(self, rev, no_backup=False):
@@ -228,9 +543,63 @@ class Repository(object):
 
         return self.local_command(cmd, extensions=['strip'])
 
-    def collapse(self, rev, message=None, user=None):
+    def phase(self, rev, draft=False, force=False):
+        cmd = ['phase', '--rev', rev]
+
+        if draft:
+            cmd.append('--draft')
+
+        if force:
+            cmd.append('--force')
+
+        return self.local_command(cmd)
+
+    def rebase(self, source=None, dest=None, abort=False):
+        cmd = ['rebase']
+
+        if source:
+            cmd.extend(['--source', source])
+
+        if dest:
+            cmd.extend(['--dest', dest])
+
+        if abort:
+            cmd.append('--abort')
+
+        return self.local_command(cmd, extensions=['rebase'])
+
+    def is_rebasing(self):
+        return os.path.exists(os.path.join(self.path, '.hg', 'rebasestate'))
+
+    def is_transplanting(self):
+        return os.path.exists(self._transplant_journal_path())
+
+    def forget_transplant(self):
+        """Remove the journal of a failed transplant, hg update doesn't do that."""
+        try:
+            os.unlink(self._transplant_journal_path())
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def _transplant_journal_path(self):
+        return os.path.join(self.path, '.hg', 'transplant', 'journal')
+
+    def store_path(self):
+        """Path of the repository that owns the store, differs from path for shares."""
+        sharedpath = os.path.join(self.path, '.hg', 'sharedpath')
+        if not os.path.exists(sharedpath):
+            return self.path
+
+        with open(sharedpath) as f:
+            return os.path.dirname(f.read().strip())
+
+    def collapse(self, rev, message=None, user=None, force=False):
         cmd = ['collapse', '--rev', rev]
 
+        if force:
+            cmd.append('--force')
+
         env = os.environ.copy()
         if message is None:
             env['EDITOR'] = 'true'
@@ -250,9 +619,59 @@ class Repository(object):
                 output += k + " = " + v + "\n"
 
         filename = self.path + "/.hg/hgrc"
+        if os.path.exists(filename):
+            with open(filename, "r") as f:
+                if f.read() == output:
+                    return
+
         with open(filename, "w") as f:
             f.write(output)
 
+        # running command servers don't re-read hgrc
+        if self.command_server_pool is not None:
+            self.command_server_pool.invalidate(self.path)
+
+
+class RusagePopen(subprocess.Popen):
+
+    """Popen that remembers the resource usage of the finished process."""
+
+    rusage = None
+
+    def wait(self):
+        while self.returncode is None:
+            try:
+                pid, status, rusage = os.wait4(self.pid, 0)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno != errno.ECHILD:
+                    raise
+
+                # somebody else has reaped the process
+                pid, status, rusage = self.pid, 0, None
+
+            if pid == self.pid:
+                self.rusage = rusage
+                self._handle_exitstatus(status)
+
+        return self.returncode
+
+
+def split_fields(chunks, count):
+    """Group null-terminated fields read from `chunks` by `count`."""
+
+    buf = ''
+    fields = []
+    for chunk in chunks:
+        parts = (buf + chunk).split('\0')
+        buf = parts.pop()
+        for part in parts:
+            fields.append(part)
+            if len(fields) == count:
+                yield fields
+                fields = []
+
 
 class MercurialException(Exception):
     def __init__(self, cmd, returncode, stdout, stderr):
@@ -18,7 +18,14 @@ class RevsetInfo(wsme.types.Base):
 
     """Repository revision set info."""
 
-    commits = wsme.types.wsattr([CommitInfo], mandatory=True)
+    #: commits of the revset, unless the lookup is still pending
+    commits = [CommitInfo]
+
+    #: id of the pending lookup, to pass as ``task`` when asking again
+    task = unicode
+
+    #: state of the pending lookup
+    state = unicode
 
 
 class TransplantItem(wsme.types.Base):
@@ -45,7 +52,10 @@ class TransplantTask(wsme.types.Base):
     src = wsme.types.wsattr(unicode, mandatory=True)
 
     #: destination repository
-    dst = wsme.types.wsattr(unicode, mandatory=True)
+    dst = unicode
+
+    #: several destination repositories, instead of ``dst``
+    dsts = [unicode]
 
     #: items to transplant
     items = wsme.types.wsattr([TransplantItem], mandatory=True)
@@ -59,6 +69,97 @@ class TransplantTaskAsyncResult(wsme.types.Base):
     task = unicode
 
 
+class TransplantBatch(wsme.types.Base):
+
+    """Batch of transplant tasks."""
+
+    #: tasks to perform, the ones with the same destination are performed in order
+    tasks = wsme.types.wsattr([TransplantTask], mandatory=True)
+
+
+class TransplantBatchAsyncResult(wsme.types.Base):
+
+    """Transplant batch async result."""
+
+    #: batch id
+    batch = unicode
+
+    #: task ids, in the same order as the tasks of the batch
+    tasks = [unicode]
+
+
+class TraceEvent(wsme.types.Base):
+
+    """An hg command or a stage of a transplant job."""
+
+    #: either command or stage
+    type = unicode
+
+    #: name of the stage or the hg subcommand
+    name = unicode
+
+    #: arguments of the hg command
+    args = [unicode]
+
+    #: local repository the hg command was run in, if any
+    path = unicode
+
+    #: ok, error (failed stage or non-zero exit code of hg), or failed (hg couldn't be run)
+    outcome = unicode
+
+    #: seconds since the start of the job
+    start = float
+
+    #: wall time, in seconds
+    duration = float
+
+    #: user CPU time of the hg process, in seconds
+    cpu_user = float
+
+    #: system CPU time of the hg process, in seconds
+    cpu_system = float
+
+    #: peak resident set size of the hg process, in kilobytes
+    max_rss = int
+
+    #: size of the output of the hg command, in bytes
+    stdout_bytes = int
+
+    #: size of the error output of the hg command, in bytes
+    stderr_bytes = int
+
+
+class TransplantTaskTrace(wsme.types.Base):
+
+    """Execution trace of a transplant task."""
+
+    #: task id
+    task = unicode
+
+    #: UTC time the task has started at
+    time = unicode
+
+    #: duration of the task, in seconds
+    duration = float
+
+    #: hg commands and stages, in the order they've started
+    events = [TraceEvent]
+
+
+class ProgressEvent(wsme.types.Base):
+
+    """Transplant task progress event."""
+
+    #: one of prepared, pulled, item_started, item_transplanted, collapsed, pushed or queued
+    event = unicode
+
+    #: index of the item the event is about, if any
+    item = int
+
+    #: UTC time of the event
+    time = unicode
+
+
 class TransplantTaskResult(wsme.types.Base):
     """Transplant task result."""
 
@@ -71,5 +172,30 @@ class TransplantTaskResult(wsme.types.Base):
     #: new tip id
     tip = unicode
 
+    #: new tip ids by destination repository, for several destinations
+    tips = {unicode: unicode}
+
+    #: errors by destination repository, for several destinations
+    errors = {unicode: unicode}
+
+    #: number of progress events published so far, while the task is in progress
+    version = int
+
+    #: progress events, while the task is in progress
+    events = [ProgressEvent]
+
     #: error
     error = unicode
+
+
+class TransplantBatchResult(wsme.types.Base):
+    """Transplant batch result."""
+
+    #: batch id
+    batch = unicode
+
+    #: state of the whole batch
+    state = unicode
+
+    #: results of the tasks, in the same order as the tasks of the batch
+    results = [TransplantTaskResult]
@@ -0,0 +1,143 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import errno
+import json
+import os
+import time
+import uuid
+
+
+class JobSpool(object):
+
+    """Jobs waiting to be applied to one destination repository, and their results.
+
+    Jobs are files named after the time they were added, so they're processed in order.
+    Applying and forgetting jobs has to be serialized by the caller (e.g. with a repository
+    lock), listing pending jobs is safe without it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def add(self, job, key=None):
+        """Queue `job` and return its id.
+
+        Jobs with the same `key` are the same job (e.g. a redelivered task and the killed one
+        it replaces), so if one is queued or has been applied, its id is returned instead.
+        A job that has failed is queued again. Adding has to be serialized by the caller too.
+        """
+
+        self._makedirs()
+        if key is not None:
+            job_id = self._find(key)
+            if job_id is not None:
+                return job_id
+
+        job_id = '{:017.6f}-{}'.format(time.time(), key or uuid.uuid4().hex)
+        self._write(self._get_job_path(job_id), job)
+        return job_id
+
+    def pending(self):
+        """Get (job id, job) pairs of jobs without results, oldest first."""
+
+        if not os.path.exists(self.path):
+            return []
+
+        jobs = []
+        for name in sorted(os.listdir(self.path)):
+            if not name.endswith('.job'):
+                continue
+
+            job_id = name[:-len('.job')]
+            if os.path.exists(self._get_result_path(job_id)):
+                continue
+
+            # tasks that don't hold the lock only read, while a job can be
+            # forgotten by the task that does
+            try:
+                with open(os.path.join(self.path, name)) as f:
+                    jobs.append((job_id, json.load(f)))
+            except IOError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+        return jobs
+
+    def set_result(self, job_id, result):
+        self._write(self._get_result_path(job_id), result)
+
+    def get_result(self, job_id):
+        """Get the result of a job, or None if it's still pending."""
+
+        try:
+            with open(self._get_result_path(job_id)) as f:
+                return json.load(f)
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+
+    def prune(self, max_age):
+        """Forget jobs whose results are older than `max_age` seconds.
+
+        Results are kept after they have been picked up, as identical jobs share them.
+        """
+
+        if not os.path.exists(self.path):
+            return
+
+        now = time.time()
+        for name in os.listdir(self.path):
+            if not name.endswith('.result'):
+                continue
+
+            path = os.path.join(self.path, name)
+            try:
+                if now - os.path.getmtime(path) > max_age:
+                    self._unlink(self._get_job_path(name[:-len('.result')]))
+                    self._unlink(path)
+            except OSError:
+                pass
+
+    def _find(self, key):
+        suffix = '-{}.job'.format(key)
+        names = [name for name in os.listdir(self.path) if name.endswith(suffix)]
+        if not names:
+            return None
+
+        job_id = max(names)[:-len('.job')]
+        result = self.get_result(job_id)
+        if result is not None and 'error' in result:
+            return None
+
+        return job_id
+
+    def _get_job_path(self, job_id):
+        return os.path.join(self.path, job_id + '.job')
+
+    def _get_result_path(self, job_id):
+        return os.path.join(self.path, job_id + '.result')
+
+    def _write(self, path, data):
+        # readers never see partially written files
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+
+        os.rename(tmp_path, path)
+
+    def _makedirs(self):
+        try:
+            os.makedirs(self.path)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _unlink(self, path):
+        try:
+            os.unlink(path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
@@ -2,10 +2,237 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import datetime
+import logging
+import threading
+import time
+
+from celery import chord
+from celery import group
+from celery import signals
+from celery.utils import uuid
 from relengapi.lib import celery
 from repository import MercurialException
+from tracing import Trace
 import actions
 
-@celery.task(throws=(MercurialException,))
-def transplant(src, dst, items):
-    return actions.transplant(src, dst, items)
+# state of a lookup that has been sent, but not started yet
+LOOKUP_QUEUED = 'QUEUED'
+
+logger = logging.getLogger(__name__)
+
+_state = threading.local()
+
+
+class ProgressPublisher(object):
+
+    """Publish progress events of a task as its PROGRESS state meta.
+
+    Each event bumps the version, so clients can wait for a version they haven't seen yet.
+    """
+
+    def __init__(self, task, task_id):
+        self.task = task
+        self.task_id = task_id
+        self.events = []
+
+    def __call__(self, event, **details):
+        details['event'] = event
+        details['time'] = datetime.datetime.utcnow().isoformat()
+        self.events.append(details)
+
+        meta = {'version': len(self.events), 'events': self.events}
+        try:
+            self.task.update_state(task_id=self.task_id, state='PROGRESS', meta=meta)
+        except Exception, e:
+            # progress is nice to have, the job itself is what matters
+            logger.warning('failed to publish progress: %s', e)
+
+
+@signals.task_prerun.connect
+def remember_task_id(task_id=None, **kwargs):
+    # self.request of tasks with a custom __call__ (like the Flask context one) is empty
+    _state.task_id = task_id
+
+
+@signals.task_postrun.connect
+def forget_task_id(**kwargs):
+    _state.task_id = None
+
+
+def get_trace_id(task_id):
+    """Get the id under which the trace of a task is stored in the result backend."""
+
+    return '{}-trace'.format(task_id)
+
+
+def save_trace(task, task_id, trace):
+    try:
+        task.backend.store_result(get_trace_id(task_id), trace.as_dict(), 'SUCCESS')
+    except Exception, e:
+        # the trace is only for troubleshooting, the job itself is what matters
+        logger.warning('failed to save trace: %s', e)
+
+
+# acknowledged once done with checkpoints enabled, see configure_acks_on_worker_init()
+@celery.task(bind=True, throws=(MercurialException,))
+def transplant(self, src, dst, items):
+    task_id = getattr(_state, 'task_id', None)
+    if task_id is None:
+        return actions.transplant(src, dst, items)
+
+    trace = Trace()
+    try:
+        with actions.reporting_progress(ProgressPublisher(self, task_id)), \
+                actions.tracing(trace):
+            return actions.transplant(src, dst, items)
+    finally:
+        # failed jobs are the most interesting ones
+        save_trace(self, task_id, trace)
+
+
+@celery.task
+def revset_info(repository_id, revset):
+    # expected errors are answered, not raised, like in the web process
+    try:
+        revset_info = actions.get_revset_info(repository_id, revset)
+    except (actions.TooManyCommitsError, actions.TransplantError, MercurialException), e:
+        return {'error': str(e)}
+
+    commits = [{
+        'node': commit.node,
+        'date': commit.date,
+        'author': commit.author,
+        'message': commit.message,
+    } for commit in revset_info.commits]
+    return {'commits': commits}
+
+
+def get_lookup_id(etag):
+    """Get the task id of the lookup of an immutable revset, shared by all its requests."""
+
+    return 'revset-{}'.format(etag)
+
+
+def get_lookup_meta(lookup_id):
+    # not cached, as a failed lookup of an immutable revset runs again under the same id
+    return revset_info.backend.get_task_meta(lookup_id, cache=False)
+
+
+def is_shared_lookup(meta):
+    """Tell whether the lookup of an immutable revset can answer other requests.
+
+    Failed lookups are run again, as the revset may be found later, e.g. once it's pushed.
+    Lookups that are queued or running are waited for, unless they've been queued for
+    longer than their time limit, as the message may have been lost with a worker.
+    """
+
+    state = meta['status']
+    if state == LOOKUP_QUEUED:
+        return time.time() - meta['result']['time'] < actions.get_lookup_time_limit()
+
+    if state == 'SUCCESS':
+        return 'error' not in meta['result']
+
+    # PENDING means there's no such lookup
+    return state in ('STARTED', 'RETRY')
+
+
+def lookup_revset(repository_id, revset, task_id=None):
+    """Look up a revset on the read-only lookup queue, return the id of the lookup."""
+
+    task_id = task_id or uuid()
+    # stored before sending, so it replaces the outcome of a previous lookup with the same id
+    # (e.g. a failed one) before anyone asks, and the worker overwrites it in turn
+    revset_info.backend.store_result(task_id, {'time': time.time()}, LOOKUP_QUEUED)
+
+    time_limit = actions.get_lookup_time_limit()
+    revset_info.apply_async((repository_id, revset), task_id=task_id, queue='lookup',
+                            soft_time_limit=time_limit, time_limit=time_limit + 10)
+    return task_id
+
+
+@celery.task
+def pin_items(src, items):
+    # a failed task would stop the chain before the chord, so its result would never be ready
+    try:
+        return actions.pin_items(src, items)
+    except Exception, e:
+        logger.warning('pinning items of "%s" failed: %s', src, e)
+        return {'error': str(e)}
+
+
+@celery.task
+def transplant_pinned(items, src, dst):
+    # items that failed to be pinned fail every destination
+    if isinstance(items, dict):
+        return items
+
+    # a failed destination must not fail the others
+    try:
+        return actions.transplant(src, dst, items)
+    except Exception, e:
+        logger.warning('transplant to "%s" failed: %s', dst, e)
+        return {'error': str(e)}
+
+
+@celery.task
+def collect_fan_out(results, dsts):
+    tips = {}
+    errors = {}
+    for dst, result in zip(dsts, results):
+        if 'error' in result:
+            errors[dst] = result['error']
+        else:
+            tips[dst] = result['tip']
+
+    return {'tips': tips, 'errors': errors}
+
+
+def transplant_fan_out(src, dsts, items):
+    """Transplant the same items to several destinations.
+
+    The source is prepared once, then destinations are transplanted to in parallel.
+    Returns the async result of the whole job.
+    """
+
+    transplants = group(transplant_pinned.s(src, dst).set(queue='transplant') for dst in dsts)
+    job = (pin_items.s(src, items).set(queue='transplant') |
+           chord(transplants, collect_fan_out.s(dsts).set(queue='transplant')))
+    return job.apply_async()
+
+
+@celery.task(ignore_result=True)
+def sync_repositories():
+    actions.sync_repositories()
+
+
+@celery.task(ignore_result=True)
+def warm_up():
+    errors = actions.warm_up()
+    if errors:
+        logger.warning('failed to warm up repositories: %s', ', '.join(sorted(errors)))
+
+
+@signals.worker_init.connect
+def warm_up_on_worker_init(sender=None, **kwargs):
+    # runs before the worker starts consuming, so it's not ready until warm up is done
+    if not sender.app.conf.get('TRANSPLANT_WARM_UP', actions.DEFAULT_WARM_UP):
+        return
+
+    # the task proxy needs a Flask app context, while the task itself sets one up
+    sender.app.tasks['{}.warm_up'.format(__name__)]()
+
+
+@signals.worker_init.connect
+def configure_acks_on_worker_init(sender=None, **kwargs):
+    # a job of a killed worker is redelivered and resumes from its checkpoint,
+    # without one it would be transplanted and pushed all over again
+    checkpoints = sender.app.conf.get('TRANSPLANT_CHECKPOINTS', actions.DEFAULT_CHECKPOINTS)
+    sender.app.tasks['{}.transplant'.format(__name__)].acks_late = bool(checkpoints)
+
+
+@signals.task_postrun.connect
+def flush_metrics_on_task_postrun(**kwargs):
+    # otherwise the metrics of the last task wait for the next one
+    actions.flush_metrics()
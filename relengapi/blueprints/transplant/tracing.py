@@ -0,0 +1,68 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import datetime
+import threading
+import time
+
+
+class Trace(object):
+
+    """Execution trace of one job: every hg command it ran and every stage it went through.
+
+    Times of events are in seconds since the start of the trace, so nested stages
+    and the commands run in them can be told apart.
+    """
+
+    def __init__(self):
+        self.start = time.time()
+        self.started = datetime.datetime.utcnow().isoformat()
+        self.lock = threading.Lock()
+        self.events = []
+
+    def add_command(self, command, args, path, outcome, duration, output_size, error_size=0,
+                    rusage=None):
+        event = {
+            'type': 'command',
+            'name': command,
+            'args': list(args),
+            'path': path,
+            'outcome': outcome,
+            'start': time.time() - duration - self.start,
+            'duration': duration,
+            'stdout_bytes': output_size,
+            'stderr_bytes': error_size,
+        }
+
+        # commands run by a command server share its process
+        if rusage is not None:
+            event['cpu_user'] = rusage.ru_utime
+            event['cpu_system'] = rusage.ru_stime
+            event['max_rss'] = rusage.ru_maxrss
+
+        self._add(event)
+
+    def add_stage(self, name, outcome, start, duration):
+        self._add({
+            'type': 'stage',
+            'name': name,
+            'outcome': outcome,
+            'start': start - self.start,
+            'duration': duration,
+        })
+
+    def as_dict(self):
+        with self.lock:
+            # stages are added when they end, after the commands they ran
+            events = sorted(self.events, key=lambda event: event['start'])
+
+        return {
+            'time': self.started,
+            'duration': time.time() - self.start,
+            'events': events,
+        }
+
+    def _add(self, event):
+        with self.lock:
+            self.events.append(event)
@@ -1,3 +1,4 @@
+from datetime import timedelta
 from kombu import Exchange, Queue
 
 RELENGAPI_PERMISSIONS = {
@@ -19,7 +20,15 @@ CELERY_BROKER_URL='redis://localhost:6379/0'
 CELERY_BACKEND='redis://localhost:6379/1'
 CELERY_QUEUES = (
     Queue('transplant', Exchange('transplant'), routing_key='transplant'),
+    Queue('lookup', Exchange('lookup'), routing_key='lookup'),
 )
+CELERYBEAT_SCHEDULE = {
+    'transplant-sync-repositories': {
+        'task': 'relengapi.blueprints.transplant.tasks.sync_repositories',
+        'schedule': timedelta(seconds=60),
+        'options': {'queue': 'transplant'},
+    },
+}
 
 TRANSPLANT_REPOSITORIES = [
     {
@@ -31,3 +40,7 @@ TRANSPLANT_REPOSITORIES = [
         "path": "ssh://hg@bitbucket.org/laggyluke/transplant-dst"
     }
 ]
+
+# set to True to look up revsets on the lookup workers (see Procfile),
+# once clients handle 202 responses
+TRANSPLANT_ASYNC_LOOKUPS = False